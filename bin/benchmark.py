@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+
+# BENCHMARK
+#
+#   Record and then play benchmark.yml against 1, 50 and 500 inventory
+#   hosts that all resolve to this machine through bin/fake_ssh.py, and
+#   report as json:
+#
+#     - wall time of each ansible-playbook run
+#     - bytes and files written to the fixture dir by the recording
+#     - count/total/percentiles of the time spent in get_fixture_file,
+#       read_exec_command and the other VCR phases (ANSIBLE_VCR_TIMINGS)
+#
+#   Any other ANSIBLE_VCR_* settings in the environment (storage, format,
+#   compression ...) apply to every run and are included in the results,
+#   so two result files can be compared to spot regressions. Without
+#   strace the delegated local tasks are captured with the snapshot backend.
+#
+#   A failed ansible-playbook run stops the benchmark and keeps its work
+#   dir, rather than reporting the wall time of a broken run.
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    from shutil import which
+except ImportError:
+    # python 2
+    from distutils.spawn import find_executable as which
+
+bd = os.path.dirname(os.path.abspath(__file__))
+pd = os.path.join(bd, '..', 'connection_plugins')
+if pd not in sys.path:
+    sys.path.insert(0, pd)
+from ansible_vcr import VCRConfig, read_timings
+
+# settings the benchmark sets itself for each run
+OWN_SETTINGS = ('mode', 'fixture_dir', 'timings')
+
+# what record and play leave behind in a run dir, emptied before each pass
+STATE_DIRS = ('remote', 'local', 'fetched')
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+def log(msg):
+    sys.stderr.write(msg + '\n')
+    sys.stderr.flush()
+
+
+def make_fake_ssh(workdir):
+    '''A PATH directory whose ssh and sftp are bin/fake_ssh.py'''
+    fakedir = os.path.join(workdir, 'fakessh')
+    os.makedirs(fakedir)
+    for name in ('ssh', 'sftp'):
+        os.symlink(os.path.join(bd, 'fake_ssh.py'), os.path.join(fakedir, name))
+    return fakedir
+
+
+def write_inventory(filen, hostcount):
+    with open(filen, 'w') as f:
+        f.write('[benchmark]\n')
+        for idx in range(1, hostcount + 1):
+            f.write('benchhost%s\n' % idx)
+
+
+def dir_usage(path):
+    '''(bytes, files) under a directory'''
+    size = 0
+    count = 0
+    for root, dirs, files in os.walk(path):
+        for fn in files:
+            fp = os.path.join(root, fn)
+            if os.path.islink(fp):
+                continue
+            size += os.path.getsize(fp)
+            count += 1
+    return (size, count)
+
+
+def run_playbook(args, mode, rundir, inventory, env):
+    '''Run one record or play pass, returns its results'''
+    timings = os.path.join(rundir, 'timings_%s.jsonl' % mode)
+    env = env.copy()
+    env['ANSIBLE_VCR_MODE'] = mode
+    env['ANSIBLE_VCR_FIXTURE_DIR'] = os.path.join(rundir, 'fixtures')
+    env['ANSIBLE_VCR_TIMINGS'] = timings
+
+    cmd = [
+        'ansible-playbook',
+        '-i', inventory,
+        '-f', str(args.forks),
+        '-e', 'bench_dir=%s' % rundir,
+        '-e', 'ansible_python_interpreter=%s' % args.python,
+        args.playbook
+    ]
+    logfile = os.path.join(rundir, 'ansible_%s.log' % mode)
+    start = time.time()
+    with open(logfile, 'w') as f:
+        rc = subprocess.call(cmd, stdout=f, stderr=subprocess.STDOUT, env=env)
+    elapsed = time.time() - start
+    if rc != 0:
+        raise BenchmarkError('%s pass failed with rc %s, see %s' % (mode, rc, logfile))
+
+    calls = {}
+    if os.path.isfile(timings):
+        calls = read_timings(timings)['phases']
+    return {
+        'wall_seconds': elapsed,
+        'calls': calls
+    }
+
+
+def reset_state_dirs(rundir):
+    '''Give each pass the same empty dirs, play would otherwise skip what
+    record already created or fetched there'''
+    for dn in STATE_DIRS:
+        shutil.rmtree(os.path.join(rundir, dn), True)
+        os.makedirs(os.path.join(rundir, dn))
+
+
+def benchmark(args, hostcount, workdir, env):
+    rundir = os.path.join(workdir, str(hostcount))
+    reset_state_dirs(rundir)
+    inventory = os.path.join(rundir, 'inventory')
+    write_inventory(inventory, hostcount)
+
+    log('# %s hosts: record' % hostcount)
+    record = run_playbook(args, 'record', rundir, inventory, env)
+    (size, count) = dir_usage(os.path.join(rundir, 'fixtures'))
+    record['fixture_bytes'] = size
+    record['fixture_files'] = count
+    record['fixture_bytes_per_host'] = size // hostcount
+
+    log('# %s hosts: play' % hostcount)
+    reset_state_dirs(rundir)
+    play = run_playbook(args, 'play', rundir, inventory, env)
+
+    return {
+        'hosts': hostcount,
+        'record': record,
+        'play': play
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hosts', default='1,50,500',
+                        help='comma separated host counts to benchmark')
+    parser.add_argument('--forks', type=int, default=25)
+    parser.add_argument('--playbook', default=os.path.join(bd, '..', 'benchmark.yml'))
+    parser.add_argument('--python', default=sys.executable,
+                        help='interpreter for the "remote" hosts')
+    parser.add_argument('--workdir', help='keep the runs here instead of a temporary dir')
+    parser.add_argument('--output', help='write the results here instead of stdout')
+    args = parser.parse_args()
+
+    workdir = args.workdir
+    if workdir:
+        if os.path.exists(workdir):
+            log('%s already exists' % workdir)
+            sys.exit(1)
+        os.makedirs(workdir)
+    else:
+        workdir = tempfile.mkdtemp(prefix='vcr-benchmark-')
+
+    fakedir = make_fake_ssh(workdir)
+    env = os.environ.copy()
+    env['PATH'] = fakedir + os.pathsep + env.get('PATH', '')
+    env['ANSIBLE_SSH_EXECUTABLE'] = os.path.join(fakedir, 'ssh')
+    env['ANSIBLE_SCP_IF_SSH'] = 'False'
+    env['ANSIBLE_HOST_KEY_CHECKING'] = 'False'
+    env['ANSIBLE_RETRY_FILES_ENABLED'] = 'False'
+    env['ANSIBLE_CALLBACK_WHITELIST'] = 'vcr'
+
+    # the delegated local tasks record through strace by default
+    if VCRConfig(environ=env).capture == 'strace' and not which('strace'):
+        log('strace not found, capturing local tasks with ANSIBLE_VCR_CAPTURE=snapshot')
+        env['ANSIBLE_VCR_CAPTURE'] = 'snapshot'
+        env.setdefault('ANSIBLE_VCR_CAPTURE_PATHS', workdir)
+
+    settings = {}
+    for name, (envvar, default) in VCRConfig.SETTINGS.items():
+        if name not in OWN_SETTINGS and envvar in env:
+            settings[name] = env[envvar]
+
+    results = {
+        'playbook': os.path.basename(args.playbook),
+        'forks': args.forks,
+        'settings': settings,
+        'runs': []
+    }
+    try:
+        for hostcount in [int(x) for x in args.hosts.split(',') if x]:
+            results['runs'].append(benchmark(args, hostcount, workdir, env))
+    except BenchmarkError as e:
+        log(str(e))
+        sys.exit(1)
+    if not args.workdir:
+        shutil.rmtree(workdir, True)
+
+    data = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(data + '\n')
+    else:
+        print(data)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+
+# BUNDLER
+#
+#   Convert an ansible-vcr recording between the fixture directory layout
+#   and a single bundle file that is easy to ship around. Play mode can
+#   read a bundle directly through ANSIBLE_VCR_BUNDLE.
+
+import argparse
+import os
+import sys
+
+pd = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'connection_plugins')
+if pd not in sys.path:
+    sys.path.insert(0, pd)
+from ansible_vcr import FixtureBundle
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='action')
+
+    export_parser = subparsers.add_parser('export', help='fixture dir -> bundle')
+    export_parser.add_argument('--fixturedir', default='/tmp/fixtures')
+    export_parser.add_argument('bundle')
+
+    import_parser = subparsers.add_parser('import', help='bundle -> fixture dir')
+    import_parser.add_argument('--fixturedir', default='/tmp/fixtures')
+    import_parser.add_argument('bundle')
+
+    args = parser.parse_args()
+
+    if args.action == 'export':
+        count = FixtureBundle.export(args.fixturedir, args.bundle)
+        print('exported %s files to %s' % (count, args.bundle))
+    elif args.action == 'import':
+        count = FixtureBundle(args.bundle).import_(args.fixturedir)
+        print('imported %s files to %s' % (count, args.fixturedir))
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
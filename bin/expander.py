@@ -4,39 +4,144 @@
 #
 #   Take the fixtures created by an ansible-vcr recording and expand them
 #   to a new arbitary hostcount.
+#
+#   Every new host directory is built from the last recorded host of each
+#   task. Fixtures are rewritten in-process with the new hostname, files
+#   that don't mention the hostname are hardlinked to the template, and the
+#   work is spread over a process pool. Manifests are written afresh for
+#   each new host and sequence counters are left out, since record mode
+#   appends to both in place.
 
 import argparse
 import glob
+import json
+import multiprocessing
 import os
 import shutil
-import subprocess
 import sys
+import time
 
+pd = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'connection_plugins')
+if pd not in sys.path:
+    sys.path.insert(0, pd)
+from ansible_vcr import FIXTURE_FORMATS, FIXTURE_PAYLOADS, MANIFEST_NAME, SEQUENCE_NAME, SQLITE_DB_NAME
+from ansible_vcr import command_fingerprint, command_key, fixture_basename, load_fixture, manifest_entry
+from ansible_vcr import write_binary_fixture
 
-def run_command(cmd):
-    p = subprocess.Popen(
-        cmd,
-        shell=True,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE
-    )
 
-    so, se = p.communicate()
-    return (p.returncode, so, se)
+def replace_hostname(data, src_hn, hn):
+    '''Recursively swap the hostname in every string of a fixture'''
+    if isinstance(data, dict):
+        return dict((k, replace_hostname(v, src_hn, hn)) for k, v in data.items())
+    if isinstance(data, list):
+        return [replace_hostname(x, src_hn, hn) for x in data]
+    if isinstance(data, (type(u''), type(''))):
+        return data.replace(src_hn, hn)
+    return data
+
+
+def link_or_copy(src, dest):
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copy2(src, dest)
+
+
+def expand_file(src, dest, src_hn, hn):
+    '''Write one file of the new host, returns True if it was rewritten'''
+    ext = os.path.splitext(src)[1]
+
+    if ext in FIXTURE_FORMATS.values():
+        # fixtures are rewritten through their format so binary headers and
+        # compressed payloads stay valid
+        fixture = load_fixture(src)
+        jdata = dict(fixture)
+        for name in FIXTURE_PAYLOADS:
+            # binary fixtures load these lazily
+            jdata[name] = fixture[name]
+        new = replace_hostname(jdata, src_hn, hn)
+        if new == jdata:
+            link_or_copy(src, dest)
+            return False
+        if new.get('fingerprint') and new.get('command'):
+            new['fingerprint'] = command_fingerprint(command_key(new['command']))
+        # the recorded placeholder offsets no longer line up after the
+        # rewrite, play mode finds them again
+        new.pop('placeholders', None)
+        if ext == FIXTURE_FORMATS['binary']:
+            write_binary_fixture(dest, new)
+        else:
+            with open(dest, 'w') as f:
+                f.write(json.dumps(new, indent=2))
+        return True
+
+    with open(src, 'rb') as f:
+        data = f.read()
+    src_b = src_hn.encode('utf-8')
+    if src_b not in data:
+        link_or_copy(src, dest)
+        return False
+    with open(dest, 'wb') as f:
+        f.write(data.replace(src_b, hn.encode('utf-8')))
+    shutil.copymode(src, dest)
+    return True
+
+
+def write_manifest(hostdir):
+    '''Index the fixtures of a new host directory'''
+    with open(os.path.join(hostdir, MANIFEST_NAME), 'w') as f:
+        for fn in sorted(os.listdir(hostdir)):
+            if os.path.splitext(fn)[1] not in FIXTURE_FORMATS.values():
+                continue
+            fp = os.path.join(hostdir, fn)
+            function = fixture_basename(fn).split('_')[-2]
+            f.write(json.dumps(manifest_entry(fp, function, load_fixture(fp))) + '\n')
+
+
+def expand_hostdir(job):
+    '''Build one new host directory from a template host directory'''
+    (src, hdir, hn) = job
+    src_hn = os.path.basename(src)
+    sequence_files = [SEQUENCE_NAME % x for x in ('exec', 'put', 'fetch')]
+    rewritten = 0
+    linked = 0
+    for root, dirs, files in os.walk(src):
+        droot = os.path.join(hdir, os.path.relpath(root, src))
+        if not os.path.isdir(droot):
+            os.makedirs(droot)
+        for fn in files:
+            # a linked counter or manifest would be shared by every new host
+            # and appended to by all of them, counters are rebuilt from the
+            # fixtures by the next recording and manifests are written below
+            if fn in sequence_files or fn == MANIFEST_NAME:
+                continue
+            if expand_file(os.path.join(root, fn), os.path.join(droot, fn), src_hn, hn):
+                rewritten += 1
+            else:
+                linked += 1
+        if MANIFEST_NAME in files:
+            write_manifest(droot)
+            rewritten += 1
+    return (rewritten, linked)
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--fixturedir', default='/tmp/fixtures')
     parser.add_argument('--hostcount', type=int)
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
     args = parser.parse_args()
 
+    if os.path.isfile(os.path.join(args.fixturedir, SQLITE_DB_NAME)):
+        print('%s is a sqlite recording, only filesystem recordings can be expanded' % args.fixturedir)
+        sys.exit(1)
+
     taskdirs = glob.glob('%s/*' % args.fixturedir)
     taskdirs = [x for x in taskdirs if x[-1].isdigit()]
 
     hostdirs = []
     for td in taskdirs:
-        hostdirs += glob.glob('%s/*' % td)
+        hostdirs += sorted(glob.glob('%s/*' % td))
 
     hosts = set()
     for hd in hostdirs:
@@ -45,7 +150,7 @@ def main():
 
     counter = len(hosts) + 1
     while len(hosts) < args.hostcount:
-        _hosts = [x for x in hosts]
+        _hosts = sorted(hosts)
         hn = _hosts[-1]
         hn_parts = hn.split('.')
         sn = hn_parts[0]
@@ -56,17 +161,34 @@ def main():
             hosts.add('.'.join(hn_parts))
         counter += 1
 
+    jobs = []
     for td in taskdirs:
         src = [x for x in hostdirs if x.startswith(td + '/')][-1]
-        src_hn = src.split('/')[-1]
-        for hn in hosts:
+        for hn in sorted(hosts):
             hdir = os.path.join(td, hn)
             if not os.path.isdir(hdir):
-                shutil.copytree(src, hdir)
-            hdir_files = glob.glob('%s/*' % hdir)
-            for hdf in hdir_files:
-                cmd = "sed -i.bak 's/%s/%s/g' %s" % (src_hn, hn, hdf)
-                (rc, so, se) = run_command(cmd)
+                jobs.append((src, hdir, hn))
+
+    start = time.time()
+    rewritten = 0
+    linked = 0
+    pool = multiprocessing.Pool(processes=args.workers)
+    try:
+        for idx, (_rewritten, _linked) in enumerate(pool.imap_unordered(expand_hostdir, jobs)):
+            rewritten += _rewritten
+            linked += _linked
+            if (idx + 1) % 100 == 0:
+                elapsed = time.time() - start
+                print('%s/%s host dirs, %0.1f files/s' % (idx + 1, len(jobs), (rewritten + linked) / elapsed))
+    finally:
+        pool.close()
+        pool.join()
+
+    elapsed = max(time.time() - start, 0.000001)
+    print(
+        'expanded %s host dirs: %s files rewritten, %s hardlinked in %0.2fs (%0.1f files/s)' %
+        (len(jobs), rewritten, linked, elapsed, (rewritten + linked) / elapsed)
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+# FAKE SSH
+#
+#   A stand-in for ssh and sftp that runs everything on this machine, so
+#   playbooks can be recorded against any number of inventory hosts
+#   without real ones. Called as ssh it runs the remote command with
+#   /bin/sh, called as sftp (through a symlink) it performs the get/put
+#   lines of a batch read from stdin. The hostname is accepted and ignored.
+#
+#   bin/benchmark.py sets this up, to use it by hand:
+#       mkdir /tmp/fakessh
+#       ln -s $(pwd)/bin/fake_ssh.py /tmp/fakessh/ssh
+#       ln -s $(pwd)/bin/fake_ssh.py /tmp/fakessh/sftp
+#       PATH=/tmp/fakessh:$PATH ANSIBLE_SSH_EXECUTABLE=/tmp/fakessh/ssh \
+#           ANSIBLE_SCP_IF_SSH=False ansible-playbook ...
+
+import os
+import shlex
+import shutil
+import sys
+
+# ssh/sftp options that take a value
+OPTIONS_WITH_ARGS = set([
+    '-B', '-b', '-c', '-D', '-E', '-F', '-i', '-J', '-L', '-l', '-m', '-O',
+    '-o', '-P', '-p', '-R', '-S', '-s', '-W', '-w'
+])
+
+
+def split_args(argv):
+    '''Returns (host, remaining args) from an ssh or sftp argv'''
+    args = list(argv)
+    while args:
+        arg = args.pop(0)
+        if arg == '--':
+            break
+        if not arg.startswith('-'):
+            return (arg, args)
+        # -oUser=x style options carry their value already
+        if arg in OPTIONS_WITH_ARGS:
+            args.pop(0)
+    if args:
+        return (args[0], args[1:])
+    return (None, [])
+
+
+def ssh(argv):
+    (host, command) = split_args(argv)
+    if not command:
+        # ControlMaster checks and the like
+        return 0
+    sys.stdout.flush()
+    os.execv('/bin/sh', ['/bin/sh', '-c', ' '.join(command)])
+
+
+def sftp(argv):
+    '''Only what ansible sends over "sftp -b -": get and put lines'''
+    for line in sys.stdin:
+        parts = shlex.split(line)
+        if not parts:
+            continue
+        if parts[0] not in ('get', 'put') or len(parts) != 3:
+            sys.stderr.write('fake sftp: unsupported command %s' % line)
+            return 1
+        (src, dest) = parts[1:]
+        try:
+            shutil.copy(src, dest)
+        except (IOError, OSError) as e:
+            sys.stderr.write('fake sftp: %s\n' % e)
+            return 1
+    return 0
+
+
+def main():
+    name = os.path.basename(sys.argv[0])
+    if name == 'sftp':
+        sys.exit(sftp(sys.argv[1:]))
+    sys.exit(ssh(sys.argv[1:]))
+
+
+if __name__ == "__main__":
+    main()
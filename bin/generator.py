@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+
+# GENERATOR
+#
+#   Write a synthetic recording of N tasks x M hosts x K calls without
+#   running anything, for scale testing play mode. Fixtures are built by
+#   AnsibleVCR._serialize_all_info from fake connections and saved through
+#   the configured storage backend, so ANSIBLE_VCR_STORAGE, _FIXTURE_FORMAT
+#   and _COMPRESSION apply just like in record mode. A callback log for the
+#   tasks is written next to them. The commands are synthetic, so play the
+#   recording back with bin/replay.py rather than ansible-playbook.
+#
+#   Exec stdout is module style json padded to --stdout-size bytes, which
+#   may be a range like 100-4096 to vary it per call. --duration gives each
+#   call a recorded duration in seconds, also fixed or a range, so play
+#   speeds and bin/report.py can be tried on the recording.
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+pd = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'connection_plugins')
+if pd not in sys.path:
+    sys.path.insert(0, pd)
+from ansible_vcr import AnsibleVCR, command_fingerprint, command_key
+
+PLAYBOOK = 'generated.yml'
+
+
+class SyntheticPlayContext(object):
+    def __init__(self, host):
+        self.host = host
+
+    def serialize(self):
+        return {
+            'remote_addr': self.host,
+            'remote_user': 'vagrant',
+            'port': 22,
+            'connection': 'ssh',
+            'become': False,
+            'only_tags': set(['all']),
+            'skip_tags': set()
+        }
+
+
+class SyntheticConnection(object):
+
+    '''Just what _serialize_all_info reads off a connection'''
+
+    transport = 'ssh'
+
+    def __init__(self, host):
+        self.host = host
+        self.user = 'vagrant'
+        self.port = 22
+        self.control_path = None
+        self.socket_path = None
+        self._play_context = SyntheticPlayContext(host)
+
+    def get_option(self, name):
+        return self.host
+
+
+def parse_size(size):
+    '''"512" or "100-4096" -> (min, max)'''
+    if '-' in size:
+        (low, high) = size.split('-', 1)
+        return (int(low), int(high))
+    return (int(size), int(size))
+
+
+def parse_duration(duration):
+    '''"0.5" or "0.1-2.5" -> (min, max) seconds'''
+    if '-' in duration:
+        (low, high) = duration.split('-', 1)
+        return (float(low), float(high))
+    return (float(duration), float(duration))
+
+
+def make_duration(rand, durations):
+    if durations is None:
+        return None
+    return rand.uniform(*durations)
+
+
+def task_info(number):
+    return {
+        'playbook': PLAYBOOK,
+        'path': '%s:%s' % (PLAYBOOK, number + 1),
+        'name': 'synthetic task %s' % number,
+        'uuid': 'synthetic-%012d' % number,
+        'number': number,
+        'calls': 1
+    }
+
+
+def hostnames(count):
+    return ['host%s.example.com' % x for x in range(1, count + 1)]
+
+
+def make_stdout(rand, sizes):
+    size = rand.randint(*sizes)
+    stdout = json.dumps({'changed': False, 'rc': 0, 'stdout': ''})
+    return json.dumps({'changed': False, 'rc': 0, 'stdout': 'x' * max(size - len(stdout), 0)})
+
+
+def init_worker(opts):
+    global OPTS, AVCR
+    OPTS = opts
+    AVCR = AnsibleVCR()
+
+
+def generate_task(number):
+    '''Write every host's fixtures for one task, returns the fixture count'''
+    rand = random.Random('%s-%s' % (OPTS['seed'], number))
+    tinfo = task_info(number)
+    taskdir = os.path.join(AVCR.fixture_dir, str(number))
+    count = 0
+
+    for hn in hostnames(OPTS['hosts']):
+        connection = SyntheticConnection(hn)
+        hostdir = os.path.join(taskdir, hn)
+        if AVCR.storage.host_dirs and not os.path.isdir(hostdir):
+            os.makedirs(hostdir)
+
+        # what get_fixture_file would have set for this task+host
+        AVCR.current_task_number = number
+        AVCR.current_task_info = tinfo
+        AVCR.current_host = hn
+
+        for call in range(OPTS['calls']):
+            tmp = 'ansible-tmp-%s.%s-%s' % (1523577514 + number, call, rand.randint(10 ** 14, 10 ** 15))
+            cmd = [
+                'ssh', '-C', '-o', 'ControlMaster=auto', '-o', 'ControlPersist=60s', hn,
+                "/bin/sh -c 'echo ~/.ansible/tmp/%s && python task%s_call%s'" % (tmp, number, call)
+            ]
+            jdata = AVCR._serialize_all_info(
+                connection, 0, make_stdout(rand, OPTS['stdout_size']), '', command=cmd,
+                duration=make_duration(rand, OPTS['duration'])
+            )
+            jdata['fingerprint'] = command_fingerprint(command_key(cmd))
+            fixture = AVCR.storage.new_fixture(hostdir, 'exec')
+            AVCR.storage.save_fixture(fixture, 'exec', jdata)
+            count += 1
+
+        for call in range(OPTS['puts']):
+            in_path = os.path.join(OPTS['payload_dir'], 'payload')
+            out_path = '~/.ansible/tmp/ansible-tmp-%s.%s/payload' % (1523577514 + number, call)
+            jdata = AVCR._serialize_all_info(
+                connection, 0, '', '', in_path=in_path, out_path=out_path,
+                duration=make_duration(rand, OPTS['duration'])
+            )
+            jdata['content'] = AVCR.storage.put_blob(in_path)
+            fixture = AVCR.storage.new_fixture(hostdir, 'put')
+            AVCR.storage.save_fixture(fixture, 'put', jdata)
+            count += 1
+
+    return count
+
+
+def write_callback_log(fixture_dir, tasks):
+    '''The log the vcr callback leaves behind after recording'''
+    logfile = os.path.join(fixture_dir, 'callback_record.log')
+    with open(logfile, 'w') as f:
+        f.write(json.dumps({'event': 'playbook', 'argv': sys.argv[:], 'playbook': PLAYBOOK}) + '\n')
+        for number in range(tasks):
+            record = task_info(number)
+            record['event'] = 'task'
+            f.write(json.dumps(record) + '\n')
+    with open(os.path.join(fixture_dir, 'callback_record.task'), 'w') as f:
+        f.write(json.dumps(task_info(tasks - 1)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fixturedir', default='/tmp/fixtures')
+    parser.add_argument('--tasks', type=int, default=10)
+    parser.add_argument('--hosts', type=int, default=10)
+    parser.add_argument('--calls', type=int, default=3, help='exec calls per task and host')
+    parser.add_argument('--puts', type=int, default=0, help='put calls per task and host')
+    parser.add_argument('--stdout-size', default='1024', help='bytes, or a min-max range')
+    parser.add_argument('--put-size', type=int, default=4096)
+    parser.add_argument('--duration', help='seconds per call, or a min-max range')
+    parser.add_argument('--seed', default='ansible-vcr')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+    args = parser.parse_args()
+
+    if os.path.exists(args.fixturedir) and os.listdir(args.fixturedir):
+        print('%s is not empty' % args.fixturedir)
+        sys.exit(1)
+    if not os.path.isdir(args.fixturedir):
+        os.makedirs(args.fixturedir)
+
+    # the settings are read when AnsibleVCR is created in each worker
+    os.environ['ANSIBLE_VCR_MODE'] = 'record'
+    os.environ['ANSIBLE_VCR_FIXTURE_DIR'] = args.fixturedir
+
+    # every put stores the same content, so the blob store keeps it once
+    payload_dir = tempfile.mkdtemp(prefix='vcr-generator-')
+    with open(os.path.join(payload_dir, 'payload'), 'wb') as f:
+        f.write(b'x' * args.put_size)
+
+    opts = {
+        'hosts': args.hosts,
+        'calls': args.calls,
+        'puts': args.puts,
+        'stdout_size': parse_size(args.stdout_size),
+        'duration': parse_duration(args.duration) if args.duration else None,
+        'payload_dir': payload_dir,
+        'seed': args.seed
+    }
+
+    write_callback_log(args.fixturedir, args.tasks)
+
+    start = time.time()
+    total = 0
+    pool = multiprocessing.Pool(processes=args.workers, initializer=init_worker, initargs=(opts,))
+    try:
+        for idx, count in enumerate(pool.imap_unordered(generate_task, range(args.tasks))):
+            total += count
+            if (idx + 1) % 100 == 0:
+                elapsed = time.time() - start
+                print('%s/%s tasks, %0.1f fixtures/s' % (idx + 1, args.tasks, total / elapsed))
+    finally:
+        pool.close()
+        pool.join()
+        shutil.rmtree(payload_dir, True)
+
+    elapsed = max(time.time() - start, 0.000001)
+    print(
+        'generated %s fixtures for %s tasks x %s hosts in %0.2fs (%0.1f fixtures/s)' %
+        (total, args.tasks, args.hosts, elapsed, total / elapsed)
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+
+# REPLAY
+#
+#   Play a recording back through AnsibleVCR.read_* the way the connection
+#   plugins would, without ansible-playbook, and report how long it took.
+#   This is how a bin/generator.py recording is played: its commands are
+#   synthetic, so no real playbook would ever send them.
+#
+#   Tasks run in order like the linear strategy. The task record the vcr
+#   callback would publish is written, then the hosts of the task are spread
+#   over --forks workers, each replaying its host's fixtures in the order
+#   they were recorded with the recorded commands and paths. Loading those
+#   happens before a task starts and is not counted. The ANSIBLE_VCR_*
+#   play settings (fast play, play speed, host template ...) apply as usual.
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+bd = os.path.dirname(os.path.abspath(__file__))
+pd = os.path.join(bd, '..', 'connection_plugins')
+if pd not in sys.path:
+    sys.path.insert(0, pd)
+from ansible_vcr import SQLITE_DB_NAME, AnsibleVCR, fixture_basename, get_config, get_storage, summarize_timings
+from generator import SyntheticConnection
+
+
+def fixture_task(fixture_dir, fixture):
+    return int(os.path.relpath(fixture, fixture_dir).split(os.sep)[0])
+
+
+def load_task_calls(storage, fixtures, scratch_dir):
+    '''host -> [(function, args)] in recorded order, and the task info the
+    fixtures were recorded under'''
+    hosts = {}
+    tinfo = None
+    for fixture in fixtures:
+        jdata = storage.load_fixture(fixture)
+        if tinfo is None:
+            tinfo = jdata.get('task_info')
+        hn = os.path.basename(os.path.dirname(fixture))
+        function = fixture_basename(os.path.basename(fixture)).split('_')[-2]
+        if function == 'exec':
+            args = (jdata['command'],)
+        elif function == 'fetch':
+            # fetched files land in the scratch dir, not where they were fetched to
+            args = (jdata['in_path'], os.path.join(scratch_dir, hn, os.path.basename(jdata['out_path'])))
+        else:
+            args = (jdata['in_path'], jdata['out_path'])
+        hosts.setdefault(hn, []).append((os.path.basename(fixture), function, args))
+
+    # fixture names start with the time they were written
+    for calls in hosts.values():
+        calls.sort()
+    return (hosts, tinfo)
+
+
+def publish_task(fixture_dir, tinfo):
+    '''What the vcr callback writes when a task starts'''
+    taskfile = os.path.join(fixture_dir, 'callback_play.task')
+    tmpfile = '%s.%s' % (taskfile, os.getpid())
+    with open(tmpfile, 'w') as f:
+        f.write(json.dumps(tinfo))
+    os.rename(tmpfile, taskfile)
+
+    record = tinfo.copy()
+    record['event'] = 'task'
+    with open(os.path.join(fixture_dir, 'callback_play.log'), 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def init_worker():
+    global AVCR
+    AVCR = AnsibleVCR()
+
+
+def replay_host(job):
+    '''Replay one host's calls of the current task, returns function ->
+    [seconds] and the errors'''
+    (hn, calls) = job
+    connection = SyntheticConnection(hn)
+    timings = {}
+    errors = []
+    for (name, function, args) in calls:
+        start = time.time()
+        try:
+            if function == 'exec':
+                AVCR.read_exec_command(connection, *args)
+            elif function == 'put':
+                AVCR.read_put_file(connection, *args)
+            elif function == 'fetch':
+                AVCR.read_fetch_file(connection, *args)
+        except Exception as e:
+            errors.append('%s/%s: %s' % (hn, name, e))
+            continue
+        timings.setdefault(function, []).append(time.time() - start)
+    return (timings, errors)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fixturedir', default='/tmp/fixtures')
+    parser.add_argument('--forks', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--json', action='store_true', help='print the results as json')
+    args = parser.parse_args()
+
+    # the settings are read when AnsibleVCR is created in each worker
+    os.environ['ANSIBLE_VCR_MODE'] = 'play'
+    os.environ['ANSIBLE_VCR_FIXTURE_DIR'] = args.fixturedir
+    if 'ANSIBLE_VCR_STORAGE' not in os.environ and os.path.isfile(os.path.join(args.fixturedir, SQLITE_DB_NAME)):
+        os.environ['ANSIBLE_VCR_STORAGE'] = 'sqlite'
+    storage = get_storage(get_config())
+
+    # start from the first fixture of every host, as a new play would
+    storage.reset_positions()
+    with open(os.path.join(args.fixturedir, 'callback_play.log'), 'w') as f:
+        f.write(json.dumps({'event': 'playbook', 'argv': sys.argv[:], 'playbook': None}) + '\n')
+
+    scratch_dir = tempfile.mkdtemp(prefix='vcr-replay-')
+    timings = {}
+    errors = []
+    tasks = 0
+    hosts = set()
+    elapsed = 0.0
+    pool = multiprocessing.Pool(processes=args.forks, initializer=init_worker)
+    try:
+        fixtures = storage.list_fixtures()
+        for (number, task_fixtures) in itertools.groupby(fixtures, lambda x: fixture_task(args.fixturedir, x)):
+            (calls, tinfo) = load_task_calls(storage, task_fixtures, scratch_dir)
+            tinfo = tinfo or {'number': number, 'calls': 1}
+            tinfo['number'] = number
+            publish_task(args.fixturedir, tinfo)
+
+            start = time.time()
+            for (_timings, _errors) in pool.imap_unordered(replay_host, sorted(calls.items())):
+                for function, seconds in _timings.items():
+                    timings.setdefault(function, []).extend(seconds)
+                errors.extend(_errors)
+            elapsed += time.time() - start
+
+            tasks += 1
+            hosts.update(calls)
+            if tasks % 100 == 0 and not args.json:
+                print('%s tasks, %0.1f calls/s' % (tasks, sum(len(x) for x in timings.values()) / elapsed))
+    finally:
+        pool.close()
+        pool.join()
+        shutil.rmtree(scratch_dir, True)
+
+    if not tasks:
+        print('no fixtures in %s' % args.fixturedir)
+        sys.exit(1)
+
+    calls = sum(len(x) for x in timings.values())
+    elapsed = max(elapsed, 0.000001)
+    results = {
+        'tasks': tasks,
+        'hosts': len(hosts),
+        'forks': args.forks,
+        'calls': calls,
+        'seconds': elapsed,
+        'calls_per_second': calls / elapsed,
+        'functions': dict((k, summarize_timings(v)) for k, v in timings.items()),
+        'errors': len(errors)
+    }
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        print(
+            'replayed %s calls for %s tasks x %s hosts on %s forks in %0.2fs (%0.1f calls/s)' %
+            (calls, tasks, len(hosts), args.forks, elapsed, calls / elapsed)
+        )
+        row = '%-8s %10s %10s %10s %10s %10s'
+        print(row % ('call', 'count', 'total', 'p50', 'p99', 'max'))
+        for function, timing in sorted(results['functions'].items()):
+            print(row % (function, timing['count'], '%0.4f' % timing['total'], '%0.6f' % timing['p50'],
+                         '%0.6f' % timing['p99'], '%0.6f' % timing['max']))
+
+    if errors:
+        for error in errors[:10]:
+            sys.stderr.write('failed: %s\n' % error)
+        sys.stderr.write('%s calls failed\n' % len(errors))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+
+# REPORT
+#
+#   Turn the call durations of a recording into per-task, per-host
+#   timelines and answer capacity questions about the play:
+#
+#     - which host held up each task under the linear strategy (the
+#       straggler) and for how long
+#     - how long the play would take with more forks, with pipelining or
+#       with the free strategy
+#
+#   Estimates replay the recorded durations through a model of the
+#   strategy: linear runs every host of a task on the forks before the
+#   next task starts, free lets each host move on as soon as its previous
+#   task is done. Pipelining is estimated by dropping the module transfer
+#   and the remote tmp dir housekeeping calls it avoids.
+
+import argparse
+import datetime
+import heapq
+import json
+import os
+import re
+import sys
+
+pd = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'connection_plugins')
+if pd not in sys.path:
+    sys.path.insert(0, pd)
+from ansible_vcr import SQLITE_DB_NAME, command_key, fixture_basename, get_config, get_storage, read_callback_log
+from ansible_vcr import percentile
+
+# exec calls that only manage the remote tmp dir, pipelining skips them
+HOUSEKEEPING_RE = re.compile(r'mkdir .*ansible-tmp|chmod u\+x|rm -f -r .*ansible-tmp')
+
+
+def fixture_time(fixture):
+    '''When a fixture was written, from the timestamp in its name'''
+    ts = '_'.join(fixture_basename(os.path.basename(fixture)).split('_')[:2])
+    return datetime.datetime.strptime(ts, '%Y-%m-%d_%H-%M-%S-%f')
+
+
+def is_housekeeping(function, command):
+    if function == 'put':
+        return True
+    if function != 'exec' or not command:
+        return False
+    return bool(HOUSEKEEPING_RE.search(command)) and 'python' not in command
+
+
+def load_calls(storage, fixture_dir):
+    '''task -> host -> [call] for every fixture that has a duration'''
+    tasks = {}
+    for fixture in storage.list_fixtures():
+        jdata = storage.load_fixture(fixture)
+        if jdata.get('duration') is None:
+            continue
+        (taskid, hn) = os.path.relpath(os.path.dirname(fixture), fixture_dir).split(os.sep)[:2]
+        function = fixture_basename(os.path.basename(fixture)).split('_')[-2]
+        command = command_key(jdata.get('command'))
+        tasks.setdefault(int(taskid), {}).setdefault(hn, []).append({
+            'function': function,
+            'duration': jdata['duration'],
+            'end': fixture_time(fixture),
+            'housekeeping': is_housekeeping(function, command)
+        })
+    return tasks
+
+
+def build_timelines(tasks):
+    '''task -> host -> start/end (seconds from the first call) and busy
+    time, where busy is the sum of the call durations'''
+    first = None
+    for hosts in tasks.values():
+        for calls in hosts.values():
+            for call in calls:
+                start = call['end'] - datetime.timedelta(seconds=call['duration'])
+                if first is None or start < first:
+                    first = start
+
+    timelines = {}
+    for taskid, hosts in tasks.items():
+        for hn, calls in hosts.items():
+            start = min(x['end'] - datetime.timedelta(seconds=x['duration']) for x in calls)
+            end = max(x['end'] for x in calls)
+            timelines.setdefault(taskid, {})[hn] = {
+                'start': (start - first).total_seconds(),
+                'end': (end - first).total_seconds(),
+                'busy': sum(x['duration'] for x in calls),
+                'pipelined': sum(x['duration'] for x in calls if not x['housekeeping']),
+                'calls': len(calls)
+            }
+    return timelines
+
+
+def makespan(durations, forks):
+    '''How long a batch of jobs takes on forks workers, taken in order'''
+    workers = [0.0] * max(min(forks, len(durations)), 1)
+    for duration in durations:
+        heapq.heappush(workers, heapq.heappop(workers) + duration)
+    return max(workers)
+
+
+def linear_time(timelines, hosts, forks, key='busy'):
+    '''Every task waits for all of its hosts before the next one starts'''
+    total = 0.0
+    for taskid in sorted(timelines):
+        durations = [timelines[taskid][hn][key] for hn in hosts if hn in timelines[taskid]]
+        total += makespan(durations, forks)
+    return total
+
+
+def free_time(timelines, hosts, forks, key='busy'):
+    '''Each host runs its next task as soon as it and a worker are free'''
+    queues = {}
+    for hn in hosts:
+        queues[hn] = [timelines[x][hn][key] for x in sorted(timelines) if hn in timelines[x]]
+
+    # hosts by when they can run their next task, in inventory order
+    ready = [(0.0, idx, hn) for idx, hn in enumerate(hosts) if queues[hn]]
+    heapq.heapify(ready)
+    workers = [0.0] * max(min(forks, len(hosts)), 1)
+    end = 0.0
+    while ready:
+        (available, idx, hn) = heapq.heappop(ready)
+        start = max(available, heapq.heappop(workers))
+        finish = start + queues[hn].pop(0)
+        heapq.heappush(workers, finish)
+        end = max(end, finish)
+        if queues[hn]:
+            heapq.heappush(ready, (finish, idx, hn))
+    return end
+
+
+def find_stragglers(timelines):
+    '''Per task, the slowest host and how much longer it took than the
+    median host, which is the time the others sat waiting under linear'''
+    stragglers = []
+    for taskid in sorted(timelines):
+        hosts = timelines[taskid]
+        busy = sorted(x['busy'] for x in hosts.values())
+        slowest = max(hosts, key=lambda x: hosts[x]['busy'])
+        stragglers.append({
+            'task': taskid,
+            'host': slowest,
+            'seconds': hosts[slowest]['busy'],
+            'p50': percentile(busy, 50),
+            'held_up': hosts[slowest]['busy'] - percentile(busy, 50)
+        })
+    return stragglers
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fixturedir', default='/tmp/fixtures')
+    parser.add_argument('--forks', type=int, default=5, help='forks the recording ran with')
+    parser.add_argument('--what-if-forks', default='10,25,50,100')
+    parser.add_argument('--top', type=int, default=10, help='stragglers to list')
+    parser.add_argument('--json', action='store_true', help='print the whole report as json')
+    args = parser.parse_args()
+
+    os.environ['ANSIBLE_VCR_FIXTURE_DIR'] = args.fixturedir
+    if 'ANSIBLE_VCR_STORAGE' not in os.environ and os.path.isfile(os.path.join(args.fixturedir, SQLITE_DB_NAME)):
+        os.environ['ANSIBLE_VCR_STORAGE'] = 'sqlite'
+    storage = get_storage(get_config())
+
+    tasks = load_calls(storage, args.fixturedir)
+    if not tasks:
+        print('no fixtures with recorded durations in %s' % args.fixturedir)
+        sys.exit(1)
+    timelines = build_timelines(tasks)
+    hosts = sorted(set(hn for x in timelines.values() for hn in x))
+
+    names = {}
+    logfile = os.path.join(args.fixturedir, 'callback_record.log')
+    if os.path.isfile(logfile):
+        for task in read_callback_log(logfile)['tasks']:
+            names[task['number']] = task['name']
+
+    recorded = sum(
+        max(x['end'] for x in hosts_.values()) - min(x['start'] for x in hosts_.values())
+        for hosts_ in timelines.values()
+    )
+    forks = sorted(set([args.forks] + [int(x) for x in args.what_if_forks.split(',') if x]))
+    estimates = []
+    for _forks in forks:
+        for strategy, func in (('linear', linear_time), ('free', free_time)):
+            for pipelining in (False, True):
+                key = 'pipelined' if pipelining else 'busy'
+                estimates.append({
+                    'strategy': strategy,
+                    'forks': _forks,
+                    'pipelining': pipelining,
+                    'seconds': func(timelines, hosts, _forks, key=key)
+                })
+
+    stragglers = find_stragglers(timelines)
+    for straggler in stragglers:
+        straggler['name'] = names.get(straggler['task'])
+
+    # with unlimited forks linear still waits for every straggler
+    critical_path = sum(x['seconds'] for x in stragglers)
+
+    report = {
+        'tasks': len(timelines),
+        'hosts': len(hosts),
+        'recorded_seconds': recorded,
+        'critical_path_seconds': critical_path,
+        'stragglers': stragglers,
+        'estimates': estimates,
+        'timelines': dict((str(k), v) for k, v in timelines.items())
+    }
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+        return
+
+    print('%s tasks x %s hosts, %0.2fs recorded' % (len(timelines), len(hosts), recorded))
+    print('critical path (sum of the stragglers): %0.2fs' % critical_path)
+    print('')
+    print('stragglers (linear strategy waits for the slowest host of each task)')
+    print('%-6s %-30s %-24s %10s %10s %10s' % ('task', 'name', 'host', 'seconds', 'p50', 'held up'))
+    for straggler in sorted(stragglers, key=lambda x: x['held_up'], reverse=True)[:args.top]:
+        print('%-6s %-30s %-24s %10.2f %10.2f %10.2f' % (
+            straggler['task'], (straggler['name'] or '')[:30], straggler['host'][:24],
+            straggler['seconds'], straggler['p50'], straggler['held_up']
+        ))
+    print('')
+    print('estimated play time')
+    print('%-8s %6s %-10s %10s' % ('strategy', 'forks', 'pipelining', 'seconds'))
+    for estimate in estimates:
+        print('%-8s %6s %-10s %10.2f' % (
+            estimate['strategy'], estimate['forks'],
+            'yes' if estimate['pipelining'] else 'no', estimate['seconds']
+        ))
+
+
+if __name__ == "__main__":
+    main()
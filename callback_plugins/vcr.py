@@ -5,11 +5,28 @@
 from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
+DOCUMENTATION = '''
+    callback: vcr
+    type: notification
+    short_description: tells the ansible-vcr connection plugins which task is running
+    description:
+        - Logs every playbook and task start for the ansible-vcr record and play modes.
+        - The ANSIBLE_VCR_* settings are read by the connection plugins, see VCRConfig.SETTINGS
+          in connection_plugins/ansible_vcr.py and the README for the list and their defaults.
+    requirements:
+      - whitelisting in configuration
+'''
+
 import json
 import os
 import sys
 from ansible.plugins.callback import CallbackBase
 
+pd = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'connection_plugins')
+if pd not in sys.path:
+    sys.path.insert(0, pd)
+from ansible_vcr import FixtureBundle, get_config, get_storage, read_timings
+
 
 PDATA = {
     'argv': [],
@@ -17,6 +34,12 @@ PDATA = {
     'tasks': []
 }
 
+# task uuid -> index of its first entry in PDATA['tasks']
+TASK_INDEX = {}
+
+# how many of the slowest hosts the timing summary lists
+TIMINGS_TOP_HOSTS = 10
+
 
 class CallbackModule(CallbackBase):
 
@@ -24,37 +47,70 @@ class CallbackModule(CallbackBase):
     CALLBACK_TYPE = 'notification'
     CALLBACK_NAME = 'vcr'
 
-    def get_logfile(self):
-        fixturedir = os.environ.get('ANSIBLE_VCR_FIXTURE_DIR', '/tmp/fixtures')
-        if not os.path.isdir(fixturedir):
-            os.makedirs(fixturedir)
-        mode = os.environ.get('ANSIBLE_VCR_MODE', '')
-        logfile = os.path.join(fixturedir, 'callback_%s.log' % mode)
+    def get_logfile(self, suffix='log'):
+        config = get_config()
+        if not os.path.isdir(config.fixture_dir):
+            os.makedirs(config.fixture_dir)
+        logfile = os.path.join(
+            config.fixture_dir,
+            'callback_%s.%s' % (config.mode, suffix)
+        )
         return logfile
 
-    def write_data(self):
-        #logdir = '/tmp/fixtures'
-        #logfile = os.path.join(logdir, 'callback.log')
+    def write_data(self, record, truncate=False):
+        '''Add one json line to the log'''
         logfile = self.get_logfile()
-        #if not os.path.isdir(logdir):
-        #    os.makedirs(logdir)
-        with open(logfile, 'w') as f:
-            f.write(json.dumps(PDATA))
+        line = json.dumps(record) + '\n'
+        if truncate:
+            # a new run starts a new log, write+rename so readers never
+            # see it half written
+            tmpfile = '%s.%s' % (logfile, os.getpid())
+            with open(tmpfile, 'w') as f:
+                f.write(line)
+            os.rename(tmpfile, logfile)
+        else:
+            # a single O_APPEND write lands whole
+            fd = os.open(logfile, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line.encode('utf-8'))
+            finally:
+                os.close(fd)
+
+    def write_current_task(self, tinfo):
+        '''Publish just the current task so forks don't parse the whole log'''
+        taskfile = self.get_logfile(suffix='task')
+        # write+rename so readers never see a partial record
+        tmpfile = '%s.%s' % (taskfile, os.getpid())
+        with open(tmpfile, 'w') as f:
+            f.write(json.dumps(tinfo))
+        os.rename(tmpfile, taskfile)
 
     def get_index_for_task_uuid(self, uuid):
-        if not PDATA['tasks']:
-            return None
-        ix = None
-        for idx,x in enumerate(PDATA['tasks']):
-            if x['uuid'] == uuid:
-                ix = idx
-                break
-        return ix
+        return TASK_INDEX.get(uuid)
 
     def v2_playbook_on_start(self, playbook):
+        first = not PDATA['playbooks']
         PDATA['argv'] = sys.argv[:]
         PDATA['playbooks'].append(playbook._file_name)
-        self.write_data()
+        record = {
+            'event': 'playbook',
+            'argv': PDATA['argv'],
+            'playbook': playbook._file_name
+        }
+        self.write_data(record, truncate=first)
+        if first:
+            self.reset_play_positions()
+
+    def reset_play_positions(self):
+        '''A new play starts from the first fixture of every host rather than
+        where the last play of this recording stopped'''
+        config = get_config()
+        if not config.play:
+            return
+        bundle = None
+        if config.bundle:
+            bundle = FixtureBundle(config.bundle)
+        get_storage(config, bundle=bundle).reset_positions()
 
     def v2_playbook_on_task_start(self, task, is_conditional):
         tinfo = {
@@ -67,10 +123,43 @@ class CallbackModule(CallbackBase):
         }
 
         ix = self.get_index_for_task_uuid(tinfo['uuid'])
-        if ix:
+        if ix is not None:
             tinfo['number'] = PDATA['tasks'][ix]['number']
             PDATA['tasks'][ix]['calls'] += 1
+        else:
+            TASK_INDEX[tinfo['uuid']] = len(PDATA['tasks'])
 
         PDATA['tasks'].append(tinfo)
         #import epdb; epdb.st()
-        self.write_data()
+        record = tinfo.copy()
+        record['event'] = 'task'
+        self.write_data(record)
+        self.write_current_task(tinfo)
+
+    def v2_playbook_on_stats(self, stats):
+        '''Merge the VCR timings every worker wrote into one summary'''
+        config = get_config()
+        if not config.timings or not os.path.isfile(config.timings):
+            return
+
+        summary = read_timings(config.timings)
+        with open(config.timings + '.summary.json', 'w') as f:
+            f.write(json.dumps(summary, indent=2, sort_keys=True))
+
+        row = '%-24s %8s %10s %10s %10s'
+        lines = [
+            'VCR TIMINGS (seconds, a phase includes the phases it calls)',
+            row % ('phase', 'calls', 'total', 'p50', 'p99')
+        ]
+        phases = sorted(summary['phases'].items(), key=lambda x: x[1]['total'], reverse=True)
+        for phase, timing in phases:
+            lines.append(row % (phase, timing['count'], '%0.4f' % timing['total'],
+                                '%0.6f' % timing['p50'], '%0.6f' % timing['p99']))
+
+        lines.append(row % ('slowest hosts', 'calls', 'total', 'p50', 'p99'))
+        hosts = sorted(summary['calls'].items(), key=lambda x: x[1]['total'], reverse=True)
+        for host, timing in hosts[:TIMINGS_TOP_HOSTS]:
+            lines.append(row % (host, timing['count'], '%0.4f' % timing['total'],
+                                '%0.6f' % timing['p50'], '%0.6f' % timing['p99']))
+
+        self._display.display('\n'.join(lines))
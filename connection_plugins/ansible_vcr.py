@@ -9,13 +9,51 @@ __metaclass__ = type
 
 
 import os
+import base64
+import bisect
 import datetime
 import difflib
+import errno
+import fcntl
+import functools
 import glob
+import gzip
+import hashlib
 import json
+import math
+import mmap
+import multiprocessing
 import re
 import shutil
+import struct
+import tempfile
+import contextlib
 import csv
+import ctypes
+import ctypes.util
+import time
+import zipfile
+import zlib
+
+try:
+    import zstandard
+    HAS_ZSTD = True
+except ImportError:
+    HAS_ZSTD = False
+
+try:
+    import sqlite3
+    HAS_SQLITE = True
+    # incremental blob I/O, python 3.11+
+    HAS_BLOBOPEN = hasattr(sqlite3.Connection, 'blobopen')
+except ImportError:
+    HAS_SQLITE = False
+    HAS_BLOBOPEN = False
+
+from ansible.module_utils._text import to_bytes, to_native, to_text
+from ansible.module_utils.parsing.convert_bool import boolean
+from ansible.module_utils.six import StringIO
+from ansible.module_utils.six.moves import configparser
 
 try:
     from __main__ import display
@@ -24,6 +62,194 @@ except ImportError:
     display = Display()
 
 
+# per task+host index of the recorded fixtures
+MANIFEST_NAME = 'manifest.jsonl'
+
+# per host directory counter of the last fixture index used by a function
+SEQUENCE_NAME = '.%s.seq'
+
+# fixture formats, json is readable and binary keeps the (potentially
+# huge) stdout/stderr out of the metadata so they can be loaded lazily
+FIXTURE_FORMATS = {
+    'json': '.json',
+    'binary': '.vcr'
+}
+BINARY_FIXTURE_MAGIC = b'AVCRFIX1'
+FIXTURE_PAYLOADS = ('stdout', 'stderr')
+
+# optional compression of payload fields and blobs, anything smaller than
+# the threshold isn't worth the cpu
+COMPRESSION_EXTS = {
+    'gzip': '.gz',
+    'zstd': '.zst'
+}
+COMPRESSION_MIN_SIZE = 4096
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+# put/fetch payloads and created artifacts, keyed by sha256
+BLOB_DIR_NAME = 'blobs'
+
+# play contexts, stored once and referenced from fixtures by sha1
+CONTEXT_DIR_NAME = 'contexts'
+BLOB_CHUNK_SIZE = 1024 * 1024
+
+# linux ioctl to share data blocks between files (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+# how play mode puts stored files back in place, see restore_file
+RESTORE_METHODS = ('auto', 'hardlink', 'copy')
+
+# how far the last play got, bundles leave these out
+PLAY_STATE_NAMES = ('fixture_play', 'fixture_play.log', 'callback_play.log', 'callback_play.task')
+
+# where fixtures, play positions and blobs are kept
+STORAGE_BACKENDS = ('filesystem', 'sqlite')
+SQLITE_DB_NAME = 'fixtures.db'
+SQLITE_TIMEOUT = 60
+SQLITE_SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS fixtures (
+        hostdir TEXT NOT NULL,
+        function TEXT NOT NULL,
+        idx INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        fingerprint TEXT,
+        command TEXT,
+        data BLOB,
+        encoding TEXT,
+        PRIMARY KEY (hostdir, function, idx)
+    )''',
+    '''CREATE INDEX IF NOT EXISTS fixtures_fingerprint
+        ON fixtures (hostdir, function, fingerprint, idx)''',
+    '''CREATE TABLE IF NOT EXISTS positions (
+        mode TEXT NOT NULL,
+        taskid INTEGER NOT NULL,
+        hostdir TEXT NOT NULL,
+        function TEXT NOT NULL,
+        name TEXT,
+        PRIMARY KEY (mode, taskid, hostdir, function)
+    )''',
+    '''CREATE TABLE IF NOT EXISTS contexts (
+        id TEXT PRIMARY KEY,
+        data TEXT NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS blobs (
+        digest TEXT PRIMARY KEY,
+        data BLOB NOT NULL,
+        encoding TEXT,
+        mode INTEGER
+    )''',
+)
+
+# per-run tokens that differ between a recording and its replay
+# ansible-tmp-<ts>-<rand> or, in newer ansible, ansible-tmp-<ts>-<pid>-<rand>
+ANSIBLE_TMP_RE = re.compile(r'ansible-tmp-(?P<ts>[0-9]+\.[0-9]+)(?:\-[0-9]+)+')
+BECOME_SUCCESS_RE = re.compile(r'BECOME-SUCCESS-[\w]+')
+# what may not touch each kind of token for it to count, kind -> (before, after)
+PLACEHOLDER_BOUNDARIES = {
+    'host': (r'(?<![\w.-])', r'(?![\w-])'),
+    'timestamp': (r'(?<![\d.])', r'(?![\d])'),
+    'tmp': (r'(?<![\w-])', r'(?![\d])'),
+    'become': ('', r'(?![\w])'),
+}
+STRACE_WRAPPER_RE = re.compile(r'^strace .*? -o \S+/test ')
+
+# successful file creating/removing syscalls in strace -ttt output, e.g.
+# 1523577514.500000 openat(AT_FDCWD, "/tmp/foo", O_WRONLY|O_CREAT, 0666) = 3
+STRACE_SYSCALLS = 'creat,open,openat,rename,renameat,renameat2,unlink,unlinkat'
+STRACE_SYSCALL_RE = re.compile(
+    r'^(?:[0-9.]+ +)?(?P<syscall>%s)\((?P<args>.*)\) += [0-9]' %
+    STRACE_SYSCALLS.replace(',', '|')
+)
+STRACE_STRING_RE = re.compile(r'"((?:[^"\\]|\\.)*)"')
+# C style escapes strace uses in strings, octal for non printable bytes
+STRACE_ESCAPE_RE = re.compile(br'\\(?:([0-7]{1,3})|x([0-9a-fA-F]{2})|(.))', re.DOTALL)
+STRACE_ESCAPES = {b'n': b'\n', b't': b'\t', b'r': b'\r', b'v': b'\v', b'f': b'\f'}
+
+# below this many per-pid files a process pool costs more than it saves
+STRACE_PARALLEL_MIN_FILES = 4
+
+# ways to find the files a local command created or removed
+CAPTURE_BACKENDS = ('strace', 'inotify', 'snapshot')
+
+# from linux/inotify.h
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+def command_fingerprint(command):
+    '''Hash a command with the per-run tokens normalized away'''
+    if command is None:
+        return None
+    command = to_text(command, errors='surrogate_or_strict')
+    command = STRACE_WRAPPER_RE.sub('', command)
+    command = ANSIBLE_TMP_RE.sub('ansible-tmp-X', command)
+    command = BECOME_SUCCESS_RE.sub('BECOME-SUCCESS-X', command)
+    return hashlib.sha1(to_bytes(command, errors='surrogate_or_strict')).hexdigest()
+
+
+def placeholder_values(command, host=None):
+    '''The per-run tokens of a command (and its host), kind -> value'''
+    values = {}
+    if command:
+        command = to_text(command, errors='surrogate_or_strict')
+        match = ANSIBLE_TMP_RE.search(command)
+        if match:
+            values['tmp'] = match.group()
+            values['timestamp'] = match.group('ts')
+        match = BECOME_SUCCESS_RE.search(command)
+        if match:
+            values['become'] = match.group()
+    if host:
+        values['host'] = host
+    return values
+
+
+def placeholder_pattern(kind, value):
+    '''A token value that can't match inside a longer word or number, so
+    host web1 leaves web10 alone and timestamp 1.5 leaves 1.55 alone'''
+    (before, after) = PLACEHOLDER_BOUNDARIES.get(kind, ('', ''))
+    return before + re.escape(value) + after
+
+
+def replace_host(text, old, new):
+    '''Swap a hostname wherever it stands on its own'''
+    return re.sub(placeholder_pattern('host', old), lambda m: new, text)
+
+
+def find_placeholders(text, values):
+    '''[start, end, kind] spans of the token values in text'''
+    if not text or not values:
+        return []
+    # longest first, so a tmp dir wins over the timestamp inside it
+    kinds = sorted(values, key=lambda x: len(values[x]), reverse=True)
+    pattern = re.compile(
+        '|'.join('(?P<%s>%s)' % (x, placeholder_pattern(x, values[x])) for x in kinds)
+    )
+    return [[m.start(), m.end(), m.lastgroup] for m in pattern.finditer(text)]
+
+
+def fill_placeholders(text, spans, values):
+    '''Rewrite every span whose kind has a value in a single pass'''
+    if not spans:
+        return text
+    pieces = []
+    pos = 0
+    for (start, end, kind) in spans:
+        pieces.append(text[pos:start])
+        pieces.append(values.get(kind, text[start:end]))
+        pos = end
+    pieces.append(text[pos:])
+    return u''.join(pieces)
+
+
 def clean_context(context):
     '''Remove sets in playcontext so it can be jsonified'''
     for k,v in context.items():
@@ -31,6 +257,793 @@ def clean_context(context):
             context[k] = [x for x in v]
     return context
 
+def get_compression(name):
+    '''Validate a compression name, None means don't compress'''
+    if not name or name.lower() == 'none':
+        return None
+    name = name.lower()
+    if name not in COMPRESSION_EXTS:
+        display.warning('unknown compression %s, not compressing' % name)
+        return None
+    if name == 'zstd' and not HAS_ZSTD:
+        display.warning('zstd compression requires the zstandard python library, using gzip')
+        return 'gzip'
+    return name
+
+
+def compress_bytes(data, compression):
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor().compress(data)
+    compressor = zlib.compressobj(6, zlib.DEFLATED, GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress_bytes(data, compression):
+    if compression == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data, GZIP_WBITS)
+
+
+def compress_file(src, dest, compression):
+    '''Stream src into a compressed dest'''
+    with open(src, 'rb') as fsrc:
+        if compression == 'zstd':
+            with open(dest, 'wb') as fdest:
+                zstandard.ZstdCompressor().copy_stream(fsrc, fdest)
+        else:
+            with gzip.open(dest, 'wb') as fdest:
+                shutil.copyfileobj(fsrc, fdest, BLOB_CHUNK_SIZE)
+
+
+def decompress_file(src, dest, compression):
+    '''Stream a compressed src out to dest'''
+    with open(dest, 'wb') as fdest:
+        if compression == 'zstd':
+            with open(src, 'rb') as fsrc:
+                zstandard.ZstdDecompressor().copy_stream(fsrc, fdest)
+        else:
+            with gzip.open(src, 'rb') as fsrc:
+                shutil.copyfileobj(fsrc, fdest, BLOB_CHUNK_SIZE)
+
+
+def compress_payloads(jdata, compression):
+    '''Copy of a json fixture with its big output fields compressed'''
+    jdata = jdata.copy()
+    for name in FIXTURE_PAYLOADS:
+        payload = to_bytes(jdata.get(name) or '', errors='surrogate_or_strict')
+        if len(payload) < COMPRESSION_MIN_SIZE:
+            continue
+        payload = compress_bytes(payload, compression)
+        jdata[name] = to_text(base64.b64encode(payload))
+        jdata.setdefault('encodings', {})[name] = compression
+    return jdata
+
+
+def decompress_payloads(jdata):
+    for name, compression in jdata.pop('encodings', {}).items():
+        payload = decompress_bytes(base64.b64decode(jdata[name]), compression)
+        jdata[name] = to_text(payload, errors='surrogate_or_strict')
+    return jdata
+
+
+def read_vcr_ini():
+    '''The [vcr] section of whichever ansible.cfg ansible would use'''
+    try:
+        from ansible.config.manager import find_ini_config_file
+    except ImportError:
+        return {}
+    cfgfile = find_ini_config_file()
+    if not cfgfile:
+        return {}
+    parser = configparser.RawConfigParser()
+    parser.read(cfgfile)
+    if not parser.has_section('vcr'):
+        return {}
+    return dict(parser.items('vcr'))
+
+
+def parse_play_speed(speed):
+    '''instant -> None, realtime -> 1.0, x4/4x/4 -> 4.0, False if invalid
+
+    The result divides recorded durations, so 4 replays four times faster
+    than recorded and 0.5 twice as slow.
+    '''
+    speed = to_text(speed).strip().lower()
+    if speed == 'instant':
+        return None
+    if speed in ('realtime', 'real-time'):
+        return 1.0
+    try:
+        scale = float(speed.strip('x'))
+    except ValueError:
+        return False
+    if scale <= 0:
+        return False
+    return scale
+
+
+class VCRConfig(object):
+
+    '''Settings shared by every VCR component
+
+    Each setting comes from its environment variable, then the [vcr] section
+    of ansible.cfg, then the default. Use get_config() so they are only
+    resolved once per process.
+    '''
+
+    # setting -> (environment variable, default)
+    SETTINGS = {
+        'mode': ('ANSIBLE_VCR_MODE', ''),
+        'fixture_dir': ('ANSIBLE_VCR_FIXTURE_DIR', '/tmp/fixtures'),
+        'fixture_format': ('ANSIBLE_VCR_FIXTURE_FORMAT', 'json'),
+        'compression': ('ANSIBLE_VCR_COMPRESSION', None),
+        'bundle': ('ANSIBLE_VCR_BUNDLE', None),
+        'host_break': ('ANSIBLE_VCR_HOST_BREAK', None),
+        'fast_play': ('ANSIBLE_VCR_FAST_PLAY', False),
+        'capture': ('ANSIBLE_VCR_CAPTURE', 'strace'),
+        'capture_paths': ('ANSIBLE_VCR_CAPTURE_PATHS', '/tmp'),
+        'restore': ('ANSIBLE_VCR_RESTORE', 'auto'),
+        'storage': ('ANSIBLE_VCR_STORAGE', 'filesystem'),
+        'timings': ('ANSIBLE_VCR_TIMINGS', None),
+        'play_speed': ('ANSIBLE_VCR_PLAY_SPEED', 'instant'),
+        'host_map': ('ANSIBLE_VCR_HOST_MAP', None),
+        'host_template': ('ANSIBLE_VCR_HOST_TEMPLATE', None),
+    }
+
+    def __init__(self, environ=None, ini=None):
+        if environ is None:
+            environ = os.environ
+        if ini is None:
+            ini = read_vcr_ini()
+
+        for name, (envvar, default) in self.SETTINGS.items():
+            value = environ.get(envvar)
+            if value is None:
+                value = ini.get(name, default)
+            setattr(self, name, value)
+
+        self.mode = (self.mode or '').lower()
+        self.fixture_format = self.fixture_format.lower()
+        if self.fixture_format not in FIXTURE_FORMATS:
+            display.warning('unknown fixture format %s, using json' % self.fixture_format)
+            self.fixture_format = 'json'
+        self.compression = get_compression(self.compression)
+        self.fast_play = boolean(self.fast_play, strict=False)
+        self.capture = self.capture.lower()
+        if self.capture not in CAPTURE_BACKENDS:
+            display.warning('unknown capture backend %s, using strace' % self.capture)
+            self.capture = 'strace'
+        self.capture_paths = [x for x in self.capture_paths.split(os.pathsep) if x]
+        self.restore = self.restore.lower()
+        if self.restore not in RESTORE_METHODS:
+            display.warning('unknown restore method %s, using auto' % self.restore)
+            self.restore = 'auto'
+        self.play_scale = parse_play_speed(self.play_speed)
+        if self.play_scale is False:
+            display.warning('unknown play speed %s, using instant' % self.play_speed)
+            self.play_speed = 'instant'
+            self.play_scale = None
+        self.storage = self.storage.lower()
+        if self.storage not in STORAGE_BACKENDS:
+            display.warning('unknown storage backend %s, using filesystem' % self.storage)
+            self.storage = 'filesystem'
+        if self.storage == 'sqlite' and not HAS_SQLITE:
+            display.warning('sqlite3 is not available, using filesystem storage')
+            self.storage = 'filesystem'
+        if self.storage == 'sqlite' and self.fixture_format != 'json':
+            display.warning('sqlite storage keeps fixtures as json, ignoring the %s fixture format' % self.fixture_format)
+            self.fixture_format = 'json'
+        if self.storage == 'sqlite' and self.restore != 'auto':
+            display.warning('sqlite storage restores files by copying them, ignoring restore=%s' % self.restore)
+
+    @property
+    def play(self):
+        return self.mode == 'play'
+
+    @property
+    def record(self):
+        return self.mode == 'record'
+
+
+_CONFIG = None
+
+
+def get_config():
+    '''The process wide VCRConfig'''
+    global _CONFIG
+    if _CONFIG is None:
+        _CONFIG = VCRConfig()
+    return _CONFIG
+
+
+class CallTimings(object):
+
+    '''Per process durations of the VCR phases
+
+    Phases nest, e.g. get_fixture_file inside read_exec_command, and are
+    buffered until the outermost one finishes. Then they go out as a
+    single json line to the timings file, so each worker's numbers are
+    already aggregated per call when the callback merges them. Workers
+    are short lived forks, so there is no later point to flush at.
+    '''
+
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.phases = {}
+        self.depth = 0
+        self.host = None
+
+    @staticmethod
+    def enabled():
+        return bool(get_config().timings)
+
+    def start(self):
+        if self.pid != os.getpid():
+            # don't flush what the parent had buffered when it forked
+            self._reset()
+        self.depth += 1
+
+    def stop(self, phase, seconds, host=None):
+        self.phases.setdefault(phase, []).append(seconds)
+        if host:
+            self.host = host
+        self.depth -= 1
+        if not self.depth:
+            self.flush(phase, seconds)
+
+    def flush(self, phase, seconds):
+        line = json.dumps({
+            'pid': self.pid,
+            'host': self.host,
+            'call': phase,
+            'seconds': seconds,
+            'phases': self.phases
+        })
+        self._reset()
+        # a single O_APPEND write lands whole, whichever fork it came from
+        fd = os.open(get_config().timings, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, to_bytes(line + '\n'))
+        finally:
+            os.close(fd)
+
+
+TIMINGS = CallTimings()
+
+
+def timed(phase):
+    '''Time each call of the decorated method as a phase, methods of
+    objects with a current_host are attributed to that host'''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if not TIMINGS.enabled():
+                return func(self, *args, **kwargs)
+            TIMINGS.start()
+            start = time.time()
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                TIMINGS.stop(phase, time.time() - start, host=getattr(self, 'current_host', None))
+        return wrapper
+    return decorator
+
+
+def percentile(values, pct):
+    '''Nearest rank percentile of already sorted values'''
+    if not values:
+        return None
+    rank = int(math.ceil(pct / 100.0 * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+def summarize_timings(seconds):
+    '''count/total/mean/percentiles/max of a list of durations'''
+    seconds = sorted(seconds)
+    total = sum(seconds)
+    return {
+        'count': len(seconds),
+        'total': total,
+        'mean': total / len(seconds) if seconds else None,
+        'p50': percentile(seconds, 50),
+        'p95': percentile(seconds, 95),
+        'p99': percentile(seconds, 99),
+        'max': seconds[-1] if seconds else None
+    }
+
+
+def read_timings(timings_file):
+    '''Merge what every worker wrote to a timings file into count/total/
+    percentile summaries per phase, per host and phase, and of the
+    outermost calls per host'''
+    phases = {}
+    hosts = {}
+    calls = {}
+    with open(timings_file, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            host = record.get('host') or 'unknown'
+            calls.setdefault(host, []).append(record['seconds'])
+            for phase, seconds in record['phases'].items():
+                phases.setdefault(phase, []).extend(seconds)
+                hosts.setdefault(host, {}).setdefault(phase, []).extend(seconds)
+
+    return {
+        'phases': dict((k, summarize_timings(v)) for k, v in phases.items()),
+        'hosts': dict(
+            (k, dict((_k, summarize_timings(_v)) for _k, _v in v.items()))
+            for k, v in hosts.items()
+        ),
+        'calls': dict((k, summarize_timings(v)) for k, v in calls.items())
+    }
+
+
+def fixture_basename(filen):
+    '''Strip the format extension, <ts>_exec_12.vcr -> <ts>_exec_12'''
+    base, ext = os.path.splitext(filen)
+    if ext in FIXTURE_FORMATS.values():
+        return base
+    return filen
+
+
+def fixture_index(filen):
+    '''Sequence number of a fixture, e.g. <ts>_exec_12.json -> 12'''
+    return int(fixture_basename(os.path.basename(filen)).split('_')[-1])
+
+
+def fixture_timestamp():
+    '''Fixtures are timestamped for easier visual sorting'''
+    return datetime.datetime.strftime(
+        datetime.datetime.now(),
+        '%Y-%m-%d_%H-%M-%S-%f'
+    )
+
+
+def command_key(cmd):
+    '''The part of a command that fixtures are matched on'''
+    if cmd is None:
+        return None
+    if isinstance(cmd, (list, tuple)):
+        return cmd[-1]
+    return cmd
+
+
+def manifest_entry(fixture_file, function, jdata):
+    return {
+        'function': function,
+        'index': fixture_index(fixture_file),
+        'file': os.path.basename(fixture_file),
+        'command': command_key(jdata.get('command')),
+        'fingerprint': jdata.get('fingerprint')
+    }
+
+
+def next_sequence(counter_file, initial=None):
+    '''Bump a counter file under an exclusive lock and return the new value
+
+    initial() gives the value to count on from when the file is new.
+    '''
+    fd = os.open(counter_file, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        # held until close, so forks bumping the same counter queue here
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        data = os.read(fd, 64).strip()
+        if data:
+            value = int(data)
+        elif initial:
+            value = initial()
+        else:
+            value = 0
+        value += 1
+        # the counter only grows, so overwriting in place never leaves
+        # stale digits behind
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.write(fd, to_bytes('%d\n' % value))
+    finally:
+        os.close(fd)
+    return value
+
+
+def write_binary_fixture(filen, jdata, compression=None):
+    '''Magic, length prefixed json header, then the raw payload fields'''
+    header = dict((k, v) for k, v in jdata.items() if k not in FIXTURE_PAYLOADS)
+    header['payloads'] = []
+    payloads = []
+    for name in FIXTURE_PAYLOADS:
+        payload = to_bytes(jdata.get(name) or '', errors='surrogate_or_strict')
+        encoding = None
+        if compression and len(payload) >= COMPRESSION_MIN_SIZE:
+            payload = compress_bytes(payload, compression)
+            encoding = compression
+        header['payloads'].append({'name': name, 'length': len(payload), 'encoding': encoding})
+        payloads.append(payload)
+
+    header = to_bytes(json.dumps(header, separators=(',', ':')))
+    with open(filen, 'wb') as f:
+        f.write(BINARY_FIXTURE_MAGIC)
+        f.write(struct.pack('>I', len(header)))
+        f.write(header)
+        for payload in payloads:
+            f.write(payload)
+
+
+class BinaryFixture(dict):
+
+    '''A binary fixture's metadata, payloads are read on first access'''
+
+    def __init__(self, filen):
+        self.filen = filen
+        with open(filen, 'rb') as f:
+            magic = f.read(len(BINARY_FIXTURE_MAGIC))
+            if magic != BINARY_FIXTURE_MAGIC:
+                raise ValueError('%s is not a binary fixture' % filen)
+            (hlen,) = struct.unpack('>I', f.read(4))
+            header = json.loads(to_text(f.read(hlen)))
+
+        offset = len(BINARY_FIXTURE_MAGIC) + 4 + hlen
+        self.payloads = {}
+        for payload in header.pop('payloads'):
+            self.payloads[payload['name']] = \
+                (offset, payload['length'], payload.get('encoding'))
+            offset += payload['length']
+
+        super(BinaryFixture, self).__init__(header)
+
+    def _read_payload(self, name):
+        (offset, length, encoding) = self.payloads[name]
+        if not length:
+            return u''
+        with open(self.filen, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                payload = mm[offset:offset + length]
+            finally:
+                mm.close()
+        if encoding:
+            payload = decompress_bytes(payload, encoding)
+        return to_text(payload, errors='surrogate_or_strict')
+
+    def __missing__(self, key):
+        if key not in self.payloads:
+            raise KeyError(key)
+        self[key] = self._read_payload(key)
+        return self[key]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+def load_fixture(filen):
+    '''Read a fixture in whichever format it was written'''
+    if filen.endswith(FIXTURE_FORMATS['binary']):
+        return BinaryFixture(filen)
+    with open(filen, 'r') as f:
+        return decompress_payloads(json.loads(f.read()))
+
+
+def makedirs_safe(path):
+    '''makedirs that tolerates other forks creating the same path'''
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def clone_file(src, dest):
+    '''Copy a file, reflinking the data when the filesystem supports it'''
+    with open(src, 'rb') as fsrc:
+        with open(dest, 'wb') as fdest:
+            try:
+                fcntl.ioctl(fdest.fileno(), FICLONE, fsrc.fileno())
+            except (IOError, OSError):
+                shutil.copyfileobj(fsrc, fdest, BLOB_CHUNK_SIZE)
+    shutil.copymode(src, dest)
+
+
+def remove_file(path):
+    '''Unlink rather than overwrite, dest may share an inode with a blob'''
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def restore_file(src, dest, method='auto'):
+    '''Put a stored file in place as cheaply as the filesystem allows
+
+    auto reflinks (copy-on-write, so the store is never touched by later
+    writes to dest) and copies when that isn't possible. hardlink shares
+    the inode outright, which is only safe if nothing edits the restored
+    file in place.
+    '''
+    remove_file(dest)
+    if method == 'hardlink':
+        try:
+            os.link(src, dest)
+            return
+        except OSError as e:
+            # EXDEV across filesystems, EPERM/EMLINK on some setups
+            display.vvvv('hardlink %s -> %s failed: %s' % (src, dest, e))
+    if method == 'copy':
+        shutil.copy(src, dest)
+    else:
+        clone_file(src, dest)
+
+
+class BlobStore(object):
+
+    '''Content addressed storage for transferred files and artifacts'''
+
+    def __init__(self, blobdir, bundle=None, compression=None, restore='auto'):
+        self.blobdir = blobdir
+        self.bundle = bundle
+        self.compression = compression
+        self.restore = restore
+
+    def get_path(self, digest, compression=None):
+        blob = os.path.join(self.blobdir, digest[:2], digest)
+        if compression:
+            blob += COMPRESSION_EXTS[compression]
+        return blob
+
+    def find(self, digest):
+        '''Locate a stored blob in whatever compression it was written'''
+        for compression in [None] + sorted(COMPRESSION_EXTS.keys()):
+            blob = self.get_path(digest, compression)
+            if os.path.isfile(blob):
+                return (blob, compression)
+            if self.bundle:
+                relpath = os.path.relpath(blob, os.path.dirname(self.blobdir))
+                if self.bundle.has(relpath):
+                    self.bundle.extract(relpath, blob)
+                    return (blob, compression)
+        return (None, None)
+
+    @staticmethod
+    def hash_file(filen):
+        sha = hashlib.sha256()
+        with open(filen, 'rb') as f:
+            for chunk in iter(lambda: f.read(BLOB_CHUNK_SIZE), b''):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def put(self, path):
+        '''Store a file, or each file of a directory, and return the digest
+        or a relpath -> digest dict'''
+        if os.path.isdir(path):
+            digests = {}
+            for root, dirs, files in os.walk(path):
+                for fn in files:
+                    fp = os.path.join(root, fn)
+                    digests[os.path.relpath(fp, path)] = self.put(fp)
+            return digests
+
+        digest = self.hash_file(path)
+        if self.find(digest)[0]:
+            return digest
+
+        compression = self.compression
+        if os.path.getsize(path) < COMPRESSION_MIN_SIZE:
+            compression = None
+        blob = self.get_path(digest, compression)
+        makedirs_safe(os.path.dirname(blob))
+
+        # forks may store the same content at once, rename is atomic
+        tmpfile = '%s.%s.tmp' % (blob, os.getpid())
+        if compression:
+            compress_file(path, tmpfile, compression)
+            shutil.copymode(path, tmpfile)
+        else:
+            clone_file(path, tmpfile)
+        os.rename(tmpfile, blob)
+        return digest
+
+    def get(self, digest, dest):
+        '''Restore what put() returned to dest'''
+        if isinstance(digest, dict):
+            # a directory, which may have been empty
+            makedirs_safe(dest)
+            for relpath, _digest in digest.items():
+                self.get(_digest, os.path.join(dest, relpath))
+            return
+
+        (blob, compression) = self.find(digest)
+        if blob is None:
+            raise IOError(errno.ENOENT, 'no blob stored for %s' % digest)
+
+        dirname = os.path.dirname(dest)
+        if dirname:
+            makedirs_safe(dirname)
+        if compression:
+            remove_file(dest)
+            decompress_file(blob, dest, compression)
+            shutil.copymode(blob, dest)
+        else:
+            restore_file(blob, dest, method=self.restore)
+
+
+def clear_positions(db_file):
+    '''Forget where previous plays of a sqlite recording got to'''
+    db = sqlite3.connect(db_file, timeout=SQLITE_TIMEOUT)
+    try:
+        # recordings from before the positions table have nothing to clear
+        if db.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'positions'").fetchone():
+            db.execute('DELETE FROM positions')
+            db.commit()
+    finally:
+        db.close()
+
+
+class FixtureBundle(object):
+
+    '''A whole recording packed into one zip file
+
+    Members are stored uncompressed under their path relative to the
+    fixture directory, and the zip central directory at the end of the file
+    is the index used to seek straight to any of them.
+    '''
+
+    def __init__(self, bundle_file):
+        self.bundle_file = bundle_file
+        self._zip = None
+        self._pid = None
+        self._dirs = None
+
+    @property
+    def zip(self):
+        # zipfile objects share a file offset, so each fork needs its own
+        if self._zip is None or self._pid != os.getpid():
+            self._zip = zipfile.ZipFile(self.bundle_file, 'r', allowZip64=True)
+            self._pid = os.getpid()
+        return self._zip
+
+    @property
+    def dirs(self):
+        '''relative dir -> member names directly inside it'''
+        if self._dirs is None:
+            self._dirs = {}
+            for name in self.zip.namelist():
+                self._dirs.setdefault(os.path.dirname(name), []).append(name)
+        return self._dirs
+
+    def has(self, relpath):
+        try:
+            self.zip.getinfo(relpath)
+        except KeyError:
+            return False
+        return True
+
+    def extract(self, relpath, dest):
+        '''Copy a single member out of the bundle'''
+        info = self.zip.getinfo(relpath)
+        makedirs_safe(os.path.dirname(dest))
+        tmpfile = '%s.%s.tmp' % (dest, os.getpid())
+        with self.zip.open(info) as fsrc:
+            with open(tmpfile, 'wb') as fdest:
+                shutil.copyfileobj(fsrc, fdest, BLOB_CHUNK_SIZE)
+        mode = (info.external_attr >> 16) & 0o777
+        if mode:
+            os.chmod(tmpfile, mode)
+        os.rename(tmpfile, dest)
+
+    def extract_tree(self, reldir, destdir):
+        '''Copy everything under a directory out of the bundle'''
+        prefix = reldir.rstrip('/') + '/'
+        for dirname, names in self.dirs.items():
+            if dirname != reldir and not dirname.startswith(prefix):
+                continue
+            for name in names:
+                dest = os.path.join(destdir, name)
+                if not os.path.exists(dest):
+                    self.extract(name, dest)
+
+    @staticmethod
+    def export(fixture_dir, bundle_file):
+        '''Pack a fixture directory into a bundle, returns the member count'''
+        count = 0
+        db_file = os.path.join(fixture_dir, SQLITE_DB_NAME)
+        db_copy = None
+        if HAS_SQLITE and os.path.isfile(db_file):
+            # fold the write ahead log into the database so it ships alone
+            db = sqlite3.connect(db_file, timeout=SQLITE_TIMEOUT)
+            db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            db.close()
+            # ship a copy without the exporter's play positions
+            (fd, db_copy) = tempfile.mkstemp(prefix='vcr-bundle-', suffix='.db')
+            os.close(fd)
+            shutil.copyfile(db_file, db_copy)
+            clear_positions(db_copy)
+        try:
+            with zipfile.ZipFile(bundle_file, 'w', zipfile.ZIP_STORED, allowZip64=True) as zf:
+                for root, dirs, files in os.walk(fixture_dir):
+                    if root == fixture_dir:
+                        dirs[:] = [x for x in dirs if x not in PLAY_STATE_NAMES]
+                        files = [x for x in files if x not in PLAY_STATE_NAMES]
+                    dirs.sort()
+                    for fn in sorted(files):
+                        fp = os.path.join(root, fn)
+                        if fp in (db_file + '-wal', db_file + '-shm'):
+                            continue
+                        if fp == db_file:
+                            zf.write(db_copy, SQLITE_DB_NAME)
+                        else:
+                            zf.write(fp, os.path.relpath(fp, fixture_dir))
+                        count += 1
+        finally:
+            if db_copy:
+                remove_file(db_copy)
+        return count
+
+    def import_(self, fixture_dir):
+        '''Unpack the whole bundle into a fixture directory'''
+        # bundles exported before play state was left out may carry it
+        names = [x for x in self.zip.namelist() if x not in PLAY_STATE_NAMES]
+        for name in names:
+            self.extract(name, os.path.join(fixture_dir, name))
+        db_file = os.path.join(fixture_dir, SQLITE_DB_NAME)
+        if HAS_SQLITE and SQLITE_DB_NAME in names:
+            clear_positions(db_file)
+        return len(names)
+
+
+def _strace_escape(match):
+    (octal, hexa, char) = match.groups()
+    if octal:
+        return struct.pack('B', int(octal, 8))
+    if hexa:
+        return struct.pack('B', int(hexa, 16))
+    return STRACE_ESCAPES.get(char, char)
+
+
+def strace_unescape(text):
+    '''The path strace printed as an escaped string, e.g. "caf\\303\\251"'''
+    if '\\' not in text:
+        return text
+    data = STRACE_ESCAPE_RE.sub(_strace_escape, to_bytes(text, errors='surrogate_or_strict'))
+    return to_native(data, errors='surrogate_or_strict')
+
+
+def parse_strace_file(filen):
+    '''Stream one strace -ff output file, returns the (created, unlinked)
+    path sets'''
+    created = set()
+    unlinked = set()
+    with open(filen, 'r') as f:
+        for line in f:
+            match = STRACE_SYSCALL_RE.match(line)
+            if not match:
+                continue
+            syscall = match.group('syscall')
+            args = match.group('args')
+            paths = [strace_unescape(x) for x in STRACE_STRING_RE.findall(args)]
+            if not paths:
+                display.vvvv('unparsable strace line: %s' % line.strip())
+                continue
+
+            if syscall == 'creat':
+                created.add(paths[0])
+            elif syscall in ('open', 'openat'):
+                if 'O_CREAT' in args:
+                    created.add(paths[0])
+            elif syscall in ('unlink', 'unlinkat'):
+                unlinked.add(paths[0])
+            elif len(paths) > 1:
+                # rename and renameat move paths[0] to paths[1]
+                unlinked.add(paths[0])
+                created.add(paths[1])
+    return (created, unlinked)
+
+
 class StraceProcessor(object):
     def __init__(self, directory):
         self.directory = directory
@@ -44,138 +1057,794 @@ class StraceProcessor(object):
     def get_removed(self):
         return list(self.unlinked)
 
+    def _parse_files(self, dirfiles):
+        '''Parse the per-pid files, in parallel when there are enough'''
+        if len(dirfiles) >= STRACE_PARALLEL_MIN_FILES:
+            processes = min(len(dirfiles), multiprocessing.cpu_count())
+            try:
+                pool = multiprocessing.Pool(processes=processes)
+            except (AssertionError, OSError) as e:
+                # e.g. daemonic workers may not have children
+                display.vvvv('strace parsing in serial: %s' % e)
+            else:
+                try:
+                    return pool.map(parse_strace_file, dirfiles)
+                finally:
+                    pool.close()
+                    pool.join()
+        return [parse_strace_file(x) for x in dirfiles]
+
+    @timed('strace_process')
     def _process(self):
-
-        syscalls = set()
-        blacklist = [
-            'execve',
-            'stat',
-            'access',
-            'fchmodat',
-            'readlink',
-            'getcwd',
-            'lstat',
-            'unlink',
-            'rmdir',
-            'utimensat'
-        ]
-
+        # strace -ff writes one file per pid
         dirfiles = glob.glob('%s/*' % self.directory)
-        lines = []
-        for dirfile in dirfiles:
-            with open(dirfile, 'r') as f:
-                lines += f.readlines()
-
-        # open("/usr/lib/locale/locale-archive", O_RDONLY|O_CLOEXEC) = 5\n
-        #cwd = None
-        #current_file = None
-        #current_fn = None
-        for idx,x in enumerate(lines):
-            x = x.strip()
-
-            time_tuple = x.split(None, 1)
-            if time_tuple[-1].startswith('+++ exited'):
-                continue
-            if ' ENOENT ' in time_tuple[-1]:
-                continue
-            if ' EEXIST ' in time_tuple[-1]:
-                continue
-            if ' SIGCHLD ' in time_tuple[-1]:
-                continue
+        for (created, unlinked) in self._parse_files(dirfiles):
+            self.created.update(created)
+            self.unlinked.update(unlinked)
 
-            syscall = time_tuple[-1].split('(', 1)[0]
-            if syscall in blacklist:
-                continue
 
-            print(syscall)
-            print(time_tuple[-1])
-            syscalls.add(syscall)
-            try:
-                xpath = time_tuple[-1].split('"', 2)[1]
-            except Exception as e:
-                print(e)
-                import epdb; epdb.st()
-
-            '''
-            if syscall == 'chdir':
-                if xpath.startswith('/'):
-                    cwd = xpath[:]
-                elif cwd:
-                    cwd = os.path.join(cwd, xpath)
-                else:
-                    cwd = xpath[:]
-                continue
+def walk_files(paths, exclude=None):
+    '''Every file under paths, skipping the exclude directory'''
+    for path in paths:
+        for root, dirs, files in os.walk(path):
+            if exclude:
+                dirs[:] = [x for x in dirs if os.path.join(root, x) != exclude]
+            for fn in files:
+                yield os.path.join(root, fn)
 
-            current_file = xpath[:]
 
-            try:
-                current_fn = int(time_tuple[1].split()[-1])
-            except Exception as e:
-                print(e)
-                continue
-                #import epdb; epdb.st()
+class SnapshotCapture(object):
 
-            if syscall == 'mkdir':
-                dirs.add(os.path.join(cwd, xpath))
-                continue
+    '''Diff the mtime+size of every file under paths before and after'''
 
-            if syscall == 'open':
-                continue
+    def __init__(self, paths, exclude=None):
+        self.paths = paths
+        self.exclude = exclude
+        self.before = self._snapshot()
 
-            #if 'write' in syscall:
-            #    import epdb; epdb.st()
-            '''
+    def _snapshot(self):
+        snapshot = {}
+        for fp in walk_files(self.paths, exclude=self.exclude):
+            try:
+                st = os.lstat(fp)
+            except OSError:
+                continue
+            snapshot[fp] = (st.st_ino, st.st_mtime, st.st_size)
+        return snapshot
+
+    def finish(self):
+        '''Returns the (created, removed) path lists'''
+        after = self._snapshot()
+        created = [k for k, v in after.items() if self.before.get(k) != v]
+        removed = [k for k in self.before if k not in after]
+        return (created, removed)
+
+
+class InotifyCapture(object):
+
+    '''Watch every directory under paths while the command runs
+
+    Events queue up in the kernel until finish() reads them. Files inside
+    directories created by the command are picked up by walking those
+    directories at the end.
+    '''
+
+    MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self, paths, exclude=None):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        self.exclude = exclude
+        self.watches = {}
+        for path in paths:
+            for root, dirs, files in os.walk(path):
+                if exclude:
+                    dirs[:] = [x for x in dirs if os.path.join(root, x) != exclude]
+                wd = self.libc.inotify_add_watch(self.fd, to_bytes(root), self.MASK)
+                if wd >= 0:
+                    self.watches[wd] = root
+                    continue
+                err = ctypes.get_errno()
+                if err == errno.ENOENT:
+                    # removed since the walk listed it, nothing to miss
+                    continue
+                # an unwatched directory would silently lose its changes,
+                # typically ENOSPC from fs.inotify.max_user_watches
+                os.close(self.fd)
+                raise OSError(err, 'inotify_add_watch failed: %s' % os.strerror(err), root)
+
+    def _events(self):
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    return
+                raise
+            offset = 0
+            while offset < len(data):
+                (wd, mask, cookie, length) = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                name = to_text(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                yield (wd, mask, name)
+
+    def finish(self):
+        '''Returns the (created, removed) path lists'''
+        created = set()
+        removed = set()
+        newdirs = set()
+        try:
+            for (wd, mask, name) in self._events():
+                if mask & IN_Q_OVERFLOW:
+                    display.warning('inotify queue overflowed, some changes were not captured')
+                    continue
+                if wd not in self.watches or not name:
+                    continue
+                fp = os.path.join(self.watches[wd], name)
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        newdirs.add(fp)
+                    continue
+                if mask & (IN_DELETE | IN_MOVED_FROM):
+                    removed.add(fp)
+                    created.discard(fp)
+                else:
+                    created.add(fp)
+                    removed.discard(fp)
+        finally:
+            os.close(self.fd)
 
-            if syscall == 'creat':
-                self.created.add(xpath)
-            elif syscall == 'unlink':
-                self.unlinked.add(xpath)
+        created.update(walk_files(newdirs, exclude=self.exclude))
+        return (list(created), list(removed))
 
-        #if len(list(syscalls)) > 1:
-        #    import epdb; epdb.st()
 
 class FixtureLogger(object):
 
-    '''CSV like file reader+writer for fixture logging'''
+    '''CSV like file reader+writer for fixture logging
+
+    Every task+host logs to its own file under fixture_<mode>/, so a forked
+    worker only reads the rows of the host it runs for instead of the
+    whole run's log. The rows read so far are cached per file along with
+    how far into it we've read.
+    '''
 
-    def __init__(self, logdir='/tmp/fixtures'):
-        mode = os.environ.get('ANSIBLE_VCR_MODE', '')
+    def __init__(self, logdir=None):
+        config = get_config()
         if not logdir:
-            logdir = \
-                os.environ.get('ANSIBLE_VCR_FIXTURE_DIR', '/tmp/fixtures')
-        self.logfile = os.path.join(logdir, 'fixture_%s.log' % mode)
+            logdir = config.fixture_dir
+        self.fixture_dir = logdir
+        self.logdir = os.path.join(logdir, 'fixture_%s' % config.mode)
+        # logs from before they were split per task+host
+        self.legacy_logfile = self.logdir + '.log'
+
+        # logfile -> (offset, {(taskid, hostdir, function): filen})
+        self.logs = {}
+        self.last_hostdir = None
+
+    def get_logfile(self, hostdir):
+        return os.path.join(self.logdir, os.path.relpath(hostdir, self.fixture_dir) + '.log')
+
+    @timed('fixture_log_read')
+    def _update_index(self, logfile):
+        '''Fold any rows appended to a log since the last call into its
+        cached index'''
+        (offset, last_files) = self.logs.get(logfile, (0, {}))
+        try:
+            with open(logfile, 'rb') as f:
+                if os.fstat(f.fileno()).st_size < offset:
+                    # the log was replaced, start over
+                    offset = 0
+                    last_files = {}
+                f.seek(offset)
+                data = f.read()
+        except (IOError, OSError):
+            self.logs.pop(logfile, None)
+            return {}
+
+        # only consume complete rows, another fork may be mid-append
+        end = data.rfind(b'\n') + 1
+        if end:
+            rows = to_native(data[:end]).splitlines()
+            for row in csv.reader(rows, delimiter=';', quotechar='"'):
+                last_files[(int(row[0]), row[1], row[2])] = row[3]
+        self.logs[logfile] = (offset + end, last_files)
+        return last_files
 
     def get_last_file(self, taskid, hostdir, function):
         '''What was the last fixture file used?'''
-        if not os.path.isfile(self.logfile):
-            return None
-
-        lf = None
-        with open(self.logfile, 'rb') as csvfile:
-            data = csv.reader(csvfile, delimiter=';', quotechar='"')
-            for row in data:
-                #pprint(row)
-                #if row[0] == taskid:
-                if int(row[0]) == taskid:
-                    if row[1] == hostdir:
-                        if row[2] == function:
-                            lf = row[3]
-        return lf
+        self.last_hostdir = hostdir
+        last_files = self._update_index(self.get_logfile(hostdir))
+        return last_files.get((taskid, hostdir, function))
 
+    @timed('fixture_log_write')
     def set_last_file(self, taskid, hostdir, function, filen):
         '''Record that a fixture was read+written in the log'''
-        with open(self.logfile, 'a') as csvfile:
-            writer = csv.writer(csvfile, delimiter=';', quotechar='"')
-            writer.writerow([taskid, hostdir, function, filen])
+        buf = StringIO()
+        writer = csv.writer(buf, delimiter=';', quotechar='"', lineterminator='\n')
+        writer.writerow([taskid, hostdir, function, filen])
+
+        logfile = self.get_logfile(hostdir)
+        makedirs_safe(os.path.dirname(logfile))
+        # a single O_APPEND write keeps rows from concurrent forks intact
+        fd = os.open(logfile, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, to_bytes(buf.getvalue()))
+        finally:
+            os.close(fd)
+        self.last_hostdir = hostdir
+
+    def reset(self):
+        '''Forget every row logged so far'''
+        shutil.rmtree(self.logdir, True)
+        remove_file(self.legacy_logfile)
+        self.logs = {}
+        self.last_hostdir = None
 
     def get_current_hostdir(self):
-        '''What task+host fixture path should we be looking at?'''
-        hd = None
-        with open(self.logfile, 'rb') as csvfile:
-            data = csv.reader(csvfile, delimiter=';', quotechar='"')
-            for row in data:
-                hd = row[1]
-        return hd
+        '''What task+host fixture path were we looking at last?'''
+        return self.last_hostdir
+
+
+class FixtureStorage(object):
+
+    '''Where a recording keeps its fixtures, play positions and blobs
+
+    Fixtures are named by new_fixture(), a path under the host directory
+    ending in _<function>_<index>, and that name is what the other methods
+    take.
+    '''
+
+    # whether the task/host directories have to exist on disk
+    host_dirs = True
+
+    def new_fixture(self, hostdir, function):
+        '''Name the next fixture recorded for a host+function'''
+        raise NotImplementedError
+
+    def save_fixture(self, fixture, function, jdata):
+        raise NotImplementedError
+
+    def load_fixture(self, fixture):
+        raise NotImplementedError
+
+    def list_fixtures(self):
+        '''Every recorded fixture, in (task, host, function, index) order'''
+        raise NotImplementedError
+
+    def find_fixtures(self, hostdir, function, index, fingerprint=None):
+        '''The fixtures recorded at index, or if those were recorded for
+        another command, at the next index recorded for the fingerprint'''
+        raise NotImplementedError
+
+    def has_host(self, taskdir, hn):
+        '''Were any fixtures recorded for this task+host?'''
+        raise NotImplementedError
+
+    def save_context(self, context_id, data):
+        '''Store a serialized play context unless it already is, for
+        whoever inspects the recording, play never reads it back'''
+        raise NotImplementedError
+
+    def get_last_file(self, taskid, hostdir, function):
+        '''What was the last fixture file used?'''
+        raise NotImplementedError
+
+    def set_last_file(self, taskid, hostdir, function, filen):
+        raise NotImplementedError
+
+    def reset_positions(self):
+        '''Start the next run from the first fixture of every host'''
+        raise NotImplementedError
+
+    def put_blob(self, path):
+        '''Store a file, or each file of a directory, and return the digest
+        or a relpath -> digest dict'''
+        raise NotImplementedError
+
+    def get_blob(self, digest, dest):
+        '''Restore what put_blob() returned to dest'''
+        raise NotImplementedError
+
+
+class FilesystemStorage(FixtureStorage):
+
+    '''One file per fixture under <fixture_dir>/<task>/<host>/, with a
+    manifest per host directory, the play position in a CSV log and blobs
+    in a content addressed tree'''
+
+    def __init__(self, fixture_dir, fixture_format='json', compression=None, bundle=None, restore='auto'):
+        self.fixture_dir = fixture_dir
+        self.fixture_format = fixture_format
+        self.compression = compression
+
+        # play straight from a bundle, host directories are unpacked into
+        # the fixture dir the first time they are needed
+        self.bundle = bundle
+
+        self.fixture_logger = FixtureLogger(fixture_dir)
+        self.blob_store = BlobStore(
+            os.path.join(fixture_dir, BLOB_DIR_NAME),
+            bundle=bundle,
+            compression=compression,
+            restore=restore
+        )
+
+        # play mode fixture manifests, keyed by host directory
+        self.manifests = {}
+
+    @staticmethod
+    def _last_index(hostdir, function):
+        '''Highest index already recorded, for directories recorded before
+        they had a counter'''
+        existing = glob.glob('%s/*_%s_*' % (hostdir, function))
+        existing = [x for x in existing if os.path.splitext(x)[1] in FIXTURE_FORMATS.values()]
+        # fetched content from old recordings can match the glob too
+        existing = [fixture_basename(x).split('_')[-1] for x in existing]
+        existing = [int(x) for x in existing if x.isdigit()]
+        return max(existing or [0])
+
+    def new_fixture(self, hostdir, function):
+        index = next_sequence(
+            os.path.join(hostdir, SEQUENCE_NAME % function),
+            initial=lambda: self._last_index(hostdir, function)
+        )
+        return os.path.join(
+            hostdir,
+            '%s_%s_%s%s' % (fixture_timestamp(), function, index, FIXTURE_FORMATS[self.fixture_format])
+        )
+
+    @timed('save_fixture')
+    def save_fixture(self, fixture, function, jdata):
+        '''Write a fixture and add it to its host's manifest'''
+        if self.fixture_format == 'binary':
+            write_binary_fixture(fixture, jdata, compression=self.compression)
+        else:
+            if self.compression:
+                jdata = compress_payloads(jdata, self.compression)
+            with open(fixture, 'w') as f:
+                json.dump(jdata, f, indent=2)
+
+        # one O_APPEND write per entry so concurrent forks don't interleave
+        entry = manifest_entry(fixture, function, jdata)
+        manifest_file = os.path.join(os.path.dirname(fixture), MANIFEST_NAME)
+        fd = os.open(manifest_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, to_bytes(json.dumps(entry) + '\n'))
+        finally:
+            os.close(fd)
+
+    @timed('load_fixture')
+    def load_fixture(self, fixture):
+        return load_fixture(fixture)
+
+    def _build_manifest(self, hostdir):
+        '''Index the fixtures of a recording that has no manifest'''
+        entries = []
+        for ef in sorted(glob.glob('%s/*' % hostdir)):
+            if os.path.splitext(ef)[1] not in FIXTURE_FORMATS.values():
+                continue
+            jdata = load_fixture(ef)
+            function = fixture_basename(os.path.basename(ef)).split('_')[-2]
+            entries.append(manifest_entry(ef, function, jdata))
+        return entries
+
+    def get_manifest(self, hostdir):
+        '''Index a host's fixtures per function by sequence number and by
+        command fingerprint'''
+        if hostdir in self.manifests:
+            return self.manifests[hostdir]
+
+        if self.bundle:
+            self.bundle.extract_tree(
+                os.path.relpath(hostdir, self.fixture_dir),
+                self.fixture_dir
+            )
+
+        manifest_file = os.path.join(hostdir, MANIFEST_NAME)
+        if os.path.isfile(manifest_file):
+            with open(manifest_file, 'r') as f:
+                entries = [json.loads(x) for x in f if x.strip()]
+        else:
+            entries = self._build_manifest(hostdir)
+
+        manifest = {}
+        for entry in entries:
+            if not entry.get('fingerprint'):
+                entry['fingerprint'] = command_fingerprint(entry['command'])
+            findex = manifest.setdefault(
+                entry['function'],
+                {'index': {}, 'fingerprint': {}}
+            )
+            findex['index'].setdefault(entry['index'], []).append(entry)
+            if entry['fingerprint']:
+                findex['fingerprint'].setdefault(entry['fingerprint'], []).append(entry['index'])
+
+        for findex in manifest.values():
+            for indexes in findex['fingerprint'].values():
+                indexes.sort()
+
+        self.manifests[hostdir] = manifest
+        return manifest
+
+    def list_fixtures(self):
+        taskdirs = [x for x in os.listdir(self.fixture_dir) if x.isdigit()]
+        for taskdir in sorted(taskdirs, key=int):
+            taskdir = os.path.join(self.fixture_dir, taskdir)
+            for hn in sorted(os.listdir(taskdir)):
+                hostdir = os.path.join(taskdir, hn)
+                if not os.path.isdir(hostdir):
+                    continue
+                manifest = self.get_manifest(hostdir)
+                for function in sorted(manifest):
+                    for index in sorted(manifest[function]['index']):
+                        for entry in manifest[function]['index'][index]:
+                            yield os.path.join(hostdir, entry['file'])
+
+    def find_fixtures(self, hostdir, function, index, fingerprint=None):
+        manifest = self.get_manifest(hostdir).get(function, {'index': {}, 'fingerprint': {}})
+        display.vvvv('%s possible choices: %s' % (hostdir, len(manifest['index'])))
+
+        entries = manifest['index'].get(index, [])
+        if fingerprint and (not entries or entries[0]['fingerprint'] != fingerprint):
+            indexes = manifest['fingerprint'].get(fingerprint, [])
+            ix = bisect.bisect_left(indexes, index)
+            if ix < len(indexes):
+                display.vvvv('%s fingerprint matched fixture %s' % (fingerprint, indexes[ix]))
+                entries = manifest['index'][indexes[ix]]
+
+        return [os.path.join(hostdir, x['file']) for x in entries]
+
+    def has_host(self, taskdir, hn):
+        hostdir = os.path.join(taskdir, hn)
+        if self.bundle and not os.path.isdir(hostdir):
+            # ask the bundle index rather than unpacking a missing host
+            return os.path.relpath(hostdir, self.fixture_dir) in self.bundle.dirs
+        return bool(self.get_manifest(hostdir))
+
+    def _context_file(self, context_id):
+        return os.path.join(self.fixture_dir, CONTEXT_DIR_NAME, context_id + '.json')
+
+    def save_context(self, context_id, data):
+        context_file = self._context_file(context_id)
+        if os.path.isfile(context_file):
+            return
+        makedirs_safe(os.path.dirname(context_file))
+        # forks may store the same context at once, rename is atomic
+        tmpfile = '%s.%s.tmp' % (context_file, os.getpid())
+        with open(tmpfile, 'w') as f:
+            f.write(data)
+        os.rename(tmpfile, context_file)
+
+    def get_last_file(self, taskid, hostdir, function):
+        return self.fixture_logger.get_last_file(taskid, hostdir, function)
+
+    def set_last_file(self, taskid, hostdir, function, filen):
+        self.fixture_logger.set_last_file(taskid, hostdir, function, filen)
+
+    def reset_positions(self):
+        self.fixture_logger.reset()
+
+    def put_blob(self, path):
+        return self.blob_store.put(path)
+
+    def get_blob(self, digest, dest):
+        self.blob_store.get(digest, dest)
+
+
+class SqliteStorage(FixtureStorage):
+
+    '''Everything in one sqlite database in WAL mode
+
+    Lookups go through indexes instead of globbing host directories, every
+    write is its own transaction and readers never block the writer, so
+    forked workers can share the database safely. Payloads are stored as
+    json, compressed past COMPRESSION_MIN_SIZE like the other formats.
+    Stored files are always restored by copying them out of the database.
+    '''
+
+    host_dirs = False
+
+    def __init__(self, fixture_dir, compression=None, bundle=None):
+        self.fixture_dir = fixture_dir
+        self.compression = compression
+        self.db_file = os.path.join(fixture_dir, SQLITE_DB_NAME)
+        self.mode = get_config().mode
+        if bundle and not os.path.isfile(self.db_file) and bundle.has(SQLITE_DB_NAME):
+            bundle.extract(SQLITE_DB_NAME, self.db_file)
+        self._db = None
+        self._pid = None
+
+    @property
+    def db(self):
+        # a connection must not cross a fork, so each process opens its own
+        if self._db is None or self._pid != os.getpid():
+            makedirs_safe(self.fixture_dir)
+            self._db = sqlite3.connect(self.db_file, timeout=SQLITE_TIMEOUT, isolation_level=None)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            for statement in SQLITE_SCHEMA:
+                self._db.execute(statement)
+            self._pid = os.getpid()
+        return self._db
+
+    @contextlib.contextmanager
+    def transaction(self):
+        '''Take the write lock up front so concurrent writers queue on the
+        busy timeout instead of failing to upgrade a read lock'''
+        db = self.db
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def _key(self, hostdir):
+        '''Host directories are stored relative so the database can move'''
+        return os.path.relpath(hostdir, self.fixture_dir)
+
+    @staticmethod
+    def _encode(data, compression):
+        if compression and len(data) >= COMPRESSION_MIN_SIZE:
+            return (compress_bytes(data, compression), compression)
+        return (data, None)
+
+    @staticmethod
+    def _decode(data, encoding):
+        data = bytes(data)
+        if encoding:
+            data = decompress_bytes(data, encoding)
+        return data
+
+    def new_fixture(self, hostdir, function):
+        key = self._key(hostdir)
+        # reserve the index in the same transaction that picks it
+        with self.transaction() as db:
+            (index,) = db.execute(
+                'SELECT COALESCE(MAX(idx), 0) + 1 FROM fixtures WHERE hostdir = ? AND function = ?',
+                (key, function)
+            ).fetchone()
+            name = '%s_%s_%s' % (fixture_timestamp(), function, index)
+            db.execute(
+                'INSERT INTO fixtures (hostdir, function, idx, name) VALUES (?, ?, ?, ?)',
+                (key, function, index, name)
+            )
+        return os.path.join(hostdir, name)
+
+    @timed('save_fixture')
+    def save_fixture(self, fixture, function, jdata):
+        data = to_bytes(json.dumps(jdata, separators=(',', ':')))
+        (data, encoding) = self._encode(data, self.compression)
+        ckey = command_key(jdata.get('command'))
+        if ckey is not None:
+            ckey = to_text(ckey, errors='surrogate_or_strict')
+        with self.transaction() as db:
+            db.execute(
+                'UPDATE fixtures SET fingerprint = ?, command = ?, data = ?, encoding = ? '
+                'WHERE hostdir = ? AND function = ? AND idx = ?',
+                (
+                    jdata.get('fingerprint'),
+                    ckey,
+                    sqlite3.Binary(data),
+                    encoding,
+                    self._key(os.path.dirname(fixture)),
+                    function,
+                    fixture_index(fixture)
+                )
+            )
+
+    @timed('load_fixture')
+    def load_fixture(self, fixture):
+        row = self.db.execute(
+            'SELECT data, encoding FROM fixtures WHERE hostdir = ? AND name = ?',
+            (self._key(os.path.dirname(fixture)), os.path.basename(fixture))
+        ).fetchone()
+        if row is None or row[0] is None:
+            raise IOError(errno.ENOENT, 'no fixture stored for %s' % fixture)
+        return json.loads(to_text(self._decode(row[0], row[1])))
+
+    def list_fixtures(self):
+        rows = self.db.execute(
+            'SELECT hostdir, name FROM fixtures WHERE data IS NOT NULL ORDER BY hostdir, function, idx'
+        )
+        # hostdir sorts as text, put the tasks in numeric order
+        rows = sorted(rows, key=lambda x: (int(x[0].split(os.sep)[0]), x[0]))
+        for (hostdir, name) in rows:
+            yield os.path.join(self.fixture_dir, hostdir, name)
+
+    def find_fixtures(self, hostdir, function, index, fingerprint=None):
+        key = self._key(hostdir)
+        query = 'SELECT name, fingerprint FROM fixtures WHERE hostdir = ? AND function = ? AND idx = ?'
+        rows = self.db.execute(query, (key, function, index)).fetchall()
+        if fingerprint and (not rows or rows[0][1] != fingerprint):
+            row = self.db.execute(
+                'SELECT idx FROM fixtures WHERE hostdir = ? AND function = ? AND fingerprint = ? AND idx >= ? '
+                'ORDER BY idx LIMIT 1',
+                (key, function, fingerprint, index)
+            ).fetchone()
+            if row:
+                display.vvvv('%s fingerprint matched fixture %s' % (fingerprint, row[0]))
+                rows = self.db.execute(query, (key, function, row[0])).fetchall()
+        return [os.path.join(hostdir, x[0]) for x in rows]
+
+    def has_host(self, taskdir, hn):
+        row = self.db.execute(
+            'SELECT 1 FROM fixtures WHERE hostdir = ? AND data IS NOT NULL LIMIT 1',
+            (self._key(os.path.join(taskdir, hn)),)
+        ).fetchone()
+        return row is not None
+
+    def save_context(self, context_id, data):
+        with self.transaction() as db:
+            db.execute(
+                'INSERT OR IGNORE INTO contexts (id, data) VALUES (?, ?)',
+                (context_id, to_text(data))
+            )
+
+    @timed('fixture_log_read')
+    def get_last_file(self, taskid, hostdir, function):
+        row = self.db.execute(
+            'SELECT name FROM positions WHERE mode = ? AND taskid = ? AND hostdir = ? AND function = ?',
+            (self.mode, taskid, self._key(hostdir), function)
+        ).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return os.path.join(self.fixture_dir, row[0])
+
+    @timed('fixture_log_write')
+    def set_last_file(self, taskid, hostdir, function, filen):
+        # virtual hosts read another host's fixtures, so keep the full name
+        if filen is not None:
+            filen = self._key(filen)
+        with self.transaction() as db:
+            db.execute(
+                'INSERT OR REPLACE INTO positions (mode, taskid, hostdir, function, name) VALUES (?, ?, ?, ?, ?)',
+                (self.mode, taskid, self._key(hostdir), function, filen)
+            )
+
+    def reset_positions(self):
+        with self.transaction() as db:
+            db.execute('DELETE FROM positions WHERE mode = ?', (self.mode,))
+
+    def put_blob(self, path):
+        if os.path.isdir(path):
+            digests = {}
+            for root, dirs, files in os.walk(path):
+                for fn in files:
+                    fp = os.path.join(root, fn)
+                    digests[os.path.relpath(fp, path)] = self.put_blob(fp)
+            return digests
+
+        # hash in chunks first, content that is already stored is never read
+        digest = BlobStore.hash_file(path)
+        if self.db.execute('SELECT 1 FROM blobs WHERE digest = ?', (digest,)).fetchone():
+            return digest
+
+        encoding = self.compression
+        if os.path.getsize(path) < COMPRESSION_MIN_SIZE:
+            encoding = None
+        src = path
+        if encoding:
+            src = '%s.%s.tmp' % (os.path.join(self.fixture_dir, digest), os.getpid())
+            compress_file(path, src, encoding)
+        try:
+            # forks storing the same content at once both land on the same row
+            with self.transaction() as db:
+                self._insert_blob(db, digest, src, encoding, os.stat(path).st_mode & 0o7777)
+        finally:
+            if encoding:
+                remove_file(src)
+        return digest
+
+    @staticmethod
+    def _insert_blob(db, digest, src, encoding, mode):
+        '''Copy a file into a blobs row, in chunks where sqlite3 has
+        incremental blob I/O'''
+        if not HAS_BLOBOPEN:
+            with open(src, 'rb') as f:
+                data = f.read()
+            db.execute(
+                'INSERT OR IGNORE INTO blobs (digest, data, encoding, mode) VALUES (?, ?, ?, ?)',
+                (digest, sqlite3.Binary(data), encoding, mode)
+            )
+            return
+
+        cursor = db.execute(
+            'INSERT OR IGNORE INTO blobs (digest, data, encoding, mode) VALUES (?, zeroblob(?), ?, ?)',
+            (digest, os.path.getsize(src), encoding, mode)
+        )
+        if not cursor.rowcount:
+            return
+        with open(src, 'rb') as f:
+            with contextlib.closing(db.blobopen('blobs', 'data', cursor.lastrowid)) as blob:
+                for chunk in iter(lambda: f.read(BLOB_CHUNK_SIZE), b''):
+                    blob.write(chunk)
+
+    def _read_blob(self, rowid, f):
+        '''Copy a blobs row out to an open file'''
+        if not HAS_BLOBOPEN:
+            (data,) = self.db.execute('SELECT data FROM blobs WHERE rowid = ?', (rowid,)).fetchone()
+            f.write(bytes(data))
+            return
+        with contextlib.closing(self.db.blobopen('blobs', 'data', rowid, readonly=True)) as blob:
+            for chunk in iter(lambda: blob.read(BLOB_CHUNK_SIZE), b''):
+                f.write(chunk)
+
+    def get_blob(self, digest, dest):
+        if isinstance(digest, dict):
+            # a directory, which may have been empty
+            makedirs_safe(dest)
+            for relpath, _digest in digest.items():
+                self.get_blob(_digest, os.path.join(dest, relpath))
+            return
+
+        row = self.db.execute(
+            'SELECT rowid, encoding, mode FROM blobs WHERE digest = ?', (digest,)
+        ).fetchone()
+        if row is None:
+            raise IOError(errno.ENOENT, 'no blob stored for %s' % digest)
+        (rowid, encoding, mode) = row
+
+        dirname = os.path.dirname(dest)
+        if dirname:
+            makedirs_safe(dirname)
+        remove_file(dest)
+        stored = dest
+        if encoding:
+            stored = '%s.%s.tmp' % (dest, os.getpid())
+        with open(stored, 'wb') as f:
+            self._read_blob(rowid, f)
+        if encoding:
+            decompress_file(stored, dest, encoding)
+            remove_file(stored)
+        if mode is not None:
+            os.chmod(dest, mode)
+
+
+def get_storage(config, bundle=None):
+    '''The FixtureStorage for the configured backend'''
+    if config.storage == 'sqlite':
+        return SqliteStorage(
+            config.fixture_dir,
+            compression=config.compression,
+            bundle=bundle
+        )
+    return FilesystemStorage(
+        config.fixture_dir,
+        fixture_format=config.fixture_format,
+        compression=config.compression,
+        bundle=bundle,
+        restore=config.restore
+    )
+
+
+def read_callback_log(logfile):
+    '''Rebuild the callback's argv/playbooks/tasks from its json lines log'''
+    logdata = {
+        'argv': [],
+        'playbooks': [],
+        'tasks': []
+    }
+    with open(logfile, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            event = record.pop('event', None)
+            if event == 'playbook':
+                logdata['argv'] = record['argv']
+                logdata['playbooks'].append(record['playbook'])
+            elif event == 'task':
+                logdata['tasks'].append(record)
+            else:
+                # logs from before json lines were one document
+                logdata = record
+    return logdata
 
 
 class VCRCallbackReader(object):
@@ -183,21 +1852,43 @@ class VCRCallbackReader(object):
     '''A callback client of sorts'''
 
     logdata = {}
-
-    def get_logfile(self):
-        fixturedir = os.environ.get('ANSIBLE_VCR_FIXTURE_DIR', '/tmp/fixtures')
-        mode = os.environ.get('ANSIBLE_VCR_MODE', '')
-        logfile = os.path.join(fixturedir, 'callback_%s.log' % mode)
+    taskdata = None
+    taskstat = None
+
+    def get_logfile(self, suffix='log'):
+        config = get_config()
+        logfile = os.path.join(
+            config.fixture_dir,
+            'callback_%s.%s' % (config.mode, suffix)
+        )
         return logfile
 
+    @timed('read_callback_log')
     def _read_log(self):
         '''Consume the current log created by the callback'''
-        logfile = self.get_logfile()
-        with open(logfile, 'r') as f:
-            self.logdata = json.loads(f.read())
+        self.logdata = read_callback_log(self.get_logfile())
+
+    @timed('read_callback_task')
+    def _read_task(self):
+        '''Consume the current task record published by the callback'''
+        taskfile = self.get_logfile(suffix='task')
+        st = os.stat(taskfile)
+        # the callback replaces the file with a rename, so a new inode or
+        # mtime means a new task and anything else can come from the cache
+        key = (st.st_ino, st.st_mtime, st.st_size)
+        if key != self.taskstat:
+            with open(taskfile, 'r') as f:
+                self.taskdata = json.loads(f.read())
+            self.taskstat = key
+        return self.taskdata
 
     def get_current_task(self):
         '''Get the very last task from the list'''
+        try:
+            return self._read_task()
+        except OSError:
+            # callback predates the task record, fall back to the full log
+            pass
         self._read_log()
         return self.logdata['tasks'][-1]
 
@@ -205,31 +1896,66 @@ class VCRCallbackReader(object):
 class AnsibleVCR(object):
 
     def __init__(self):
-        self.mode = os.environ.get('ANSIBLE_VCR_MODE', None)
-        self.fixture_dir = \
-            os.environ.get('ANSIBLE_VCR_FIXTURE_DIR', '/tmp/fixtures')
-        self.fixture_logger = FixtureLogger(self.fixture_dir)
+        self.config = get_config()
+        self.mode = self.config.mode
+        self.fixture_dir = self.config.fixture_dir
+        self.fixture_format = self.config.fixture_format
+        self.compression = self.config.compression
+
+        self.bundle = None
+        if self.config.bundle and self.config.play:
+            self.bundle = FixtureBundle(self.config.bundle)
+        self.storage = get_storage(self.config, bundle=self.bundle)
+
         self.callback_reader = VCRCallbackReader()
         self.current_task_number = None
         self.current_task_info = None
 
+        # inventory host -> recorded host whose fixtures it replays, and the
+        # (template, host) pair for the fixture being read right now
+        self.host_map = {}
+        if self.config.host_map:
+            with open(self.config.host_map, 'r') as f:
+                self.host_map = json.loads(f.read())
+        self.current_host = None
+        self.current_alias = None
+
+        # (task number, host) -> id of its stored play context
+        self.contexts = {}
+
         self.exec_index = 0
         self.put_index = 0
         self.fetch_index = 0
 
-    def _serialize_all_info(self, connection, returncode, stdout, stderr, command=None, in_path=None, out_path=None):
+    def _get_context_id(self, connection):
+        '''Store the play context the first time a task+host records and
+        hand out its id after that'''
+        key = (self.current_task_number, self.current_host)
+        if key not in self.contexts:
+            data = json.dumps(
+                clean_context(connection._play_context.serialize()),
+                sort_keys=True
+            )
+            context_id = hashlib.sha1(to_bytes(data)).hexdigest()
+            self.storage.save_context(context_id, data)
+            self.contexts[key] = context_id
+        return self.contexts[key]
+
+    @timed('serialize')
+    def _serialize_all_info(self, connection, returncode, stdout, stderr, command=None, in_path=None, out_path=None, duration=None):
         # build the datastructure with everything we know ...
 
         jdata = {
             'task_info': self.current_task_info.copy(),
-            'context': clean_context(connection._play_context.serialize()),
+            'context_id': self._get_context_id(connection),
             'transport': connection.transport,
             'command': command,
             'in_path': in_path,
             'out_path': out_path,
             'returncode': returncode,
             'stdout': stdout,
-            'stderr': stderr
+            'stderr': stderr,
+            'duration': duration
         }
 
         for attrib in ['host', 'user', 'port', 'control_path', 'socket_path']:
@@ -241,14 +1967,83 @@ class AnsibleVCR(object):
                 else:
                     jdata[attrib] = None
 
-        try:
-            json.dumps(jdata)
-        except Exception as e:
-            print(e)
-            import epdb; epdb.st()
+        # remember where the per-run tokens are so play mode can swap them
+        # without searching the output again
+        values = placeholder_values(command_key(command), self.current_host)
+        jdata['placeholders'] = {
+            'values': values,
+            'spans': self._find_placeholder_spans(jdata, values)
+        }
 
         return jdata
 
+    def _find_placeholder_spans(self, jdata, values):
+        spans = {}
+        for field in FIXTURE_PAYLOADS:
+            if jdata.get(field):
+                text = to_text(jdata[field], errors='surrogate_or_strict')
+                spans[field] = find_placeholders(text, values)
+        ckey = command_key(jdata.get('command'))
+        if ckey:
+            spans['command'] = \
+                find_placeholders(to_text(ckey, errors='surrogate_or_strict'), values)
+        return spans
+
+    @timed('fill_placeholders')
+    def _fill_placeholders(self, jdata, cmd=None):
+        '''Swap the recorded per-run tokens for this run's in one pass'''
+        host = self.current_host
+        recorded_host = None
+        if self.current_alias:
+            (recorded_host, host) = self.current_alias
+
+        placeholders = jdata.get('placeholders')
+        if placeholders:
+            values = placeholders['values']
+            spans = placeholders['spans']
+        else:
+            # recorded before placeholders were, find them now
+            values = placeholder_values(command_key(jdata.get('command')), recorded_host)
+            spans = self._find_placeholder_spans(jdata, values)
+
+        live = placeholder_values(command_key(cmd), host)
+        live = dict((k, v) for k, v in live.items() if values.get(k) not in (None, v))
+        if not live:
+            return jdata
+
+        for field in FIXTURE_PAYLOADS:
+            if spans.get(field):
+                jdata[field] = fill_placeholders(jdata[field], spans[field], live)
+        if spans.get('command'):
+            if isinstance(jdata['command'], list):
+                jdata['command'][-1] = fill_placeholders(jdata['command'][-1], spans['command'], live)
+            else:
+                jdata['command'] = fill_placeholders(jdata['command'], spans['command'], live)
+        return jdata
+
+    def get_template_host(self, hn, taskdir):
+        '''Which recorded host's fixtures should this host replay?'''
+        if hn in self.host_map:
+            return self.host_map[hn]
+        if self.config.host_template and not self.storage.has_host(taskdir, hn):
+            return self.config.host_template
+        return hn
+
+    def _alias_fixture(self, jdata):
+        '''Swap the template hostname in paths for the virtual host replaying
+        it, output and commands are handled by _fill_placeholders'''
+        if not self.current_alias:
+            return jdata
+        (template, hn) = self.current_alias
+
+        if jdata.get('removed'):
+            jdata['removed'] = [replace_host(x, template, hn) for x in jdata['removed']]
+        if jdata.get('created'):
+            jdata['created'] = dict(
+                (replace_host(k, template, hn), v) for k, v in jdata['created'].items()
+            )
+        return jdata
+
     def get_strace_exec(self, connection, cmd):
 
         task_info = self.callback_reader.get_current_task()
@@ -263,13 +2058,73 @@ class AnsibleVCR(object):
             os.makedirs(strace_dir)
 
         einfo = {
+            'backend': 'strace',
+            'start': time.time(),
             'dir': strace_dir,
             'cmd_orig': cmd[:],
-            'cmd': 'strace -fftttv -e trace=creat,unlink -o ' + strace_dir + '/test ' + cmd
+            'cmd': 'strace -fftttv -e trace=' + STRACE_SYSCALLS + ' -o ' + strace_dir + '/test ' + cmd
         }
 
         return (einfo['cmd'], einfo)
 
+    def get_capture_exec(self, connection, cmd):
+        '''Start the configured file change capture for a local command'''
+        if self.config.capture == 'strace':
+            return self.get_strace_exec(connection, cmd)
+
+        start = time.time()
+        backend = self.config.capture
+        capture = None
+        if backend == 'inotify':
+            try:
+                capture = InotifyCapture(self.config.capture_paths, exclude=self.fixture_dir)
+            except (AttributeError, OSError) as e:
+                display.warning('inotify capture unavailable (%s), using snapshot' % e)
+                backend = 'snapshot'
+        if capture is None:
+            capture = SnapshotCapture(self.config.capture_paths, exclude=self.fixture_dir)
+
+        cinfo = {
+            'backend': backend,
+            'start': start,
+            'paths': self.config.capture_paths,
+            'capture': capture
+        }
+        return (cmd, cinfo)
+
+    @timed('capture_finish')
+    def _finish_capture(self, capture_info, fixture_file, jdata):
+        '''Collect what a capture saw, returns (created, removed)'''
+        created = []
+        removed = []
+        finish = time.time()
+        if capture_info['backend'] == 'strace':
+            jdata['command'] = capture_info['cmd']
+            jdata['strace_info'] = capture_info.copy()
+            if os.path.isdir(capture_info['dir']):
+                sp = StraceProcessor(capture_info['dir'])
+                created = sp.get_created()
+                removed = sp.get_removed()
+
+                fdir = fixture_basename(fixture_file) + '.strace'
+                shutil.copytree(capture_info['dir'], fdir)
+                shutil.rmtree(capture_info['dir'])
+        else:
+            (created, removed) = capture_info['capture'].finish()
+
+        # total includes the command itself, so backends can be compared
+        # by recording the same playbook with each of them
+        end = time.time()
+        jdata['capture_info'] = {
+            'backend': capture_info['backend'],
+            'paths': capture_info.get('paths'),
+            'seconds': end - capture_info['start'],
+            'finish_seconds': end - finish
+        }
+        display.vvv('%s capture took %0.3fs' % (capture_info['backend'], end - capture_info['start']))
+        return (created, removed)
+
+    @timed('get_fixture_file')
     def get_fixture_file(self, function, op, argvals=None, connection=None, cmd=None):
         '''Use the data to generate a fixture filename for the caller'''
 
@@ -289,8 +2144,13 @@ class AnsibleVCR(object):
 
         # set the top level directory for the task fixtures
         taskdir = os.path.join(self.fixture_dir, str(self.current_task_number))
+
+        # fast play only ever reads, so there is nothing to create, and
+        # storage that doesn't keep fixtures in directories needs none
+        fast_play = op == 'read' and self.config.fast_play
+        make_dirs = not fast_play and self.storage.host_dirs
         try:
-            if not os.path.isdir(taskdir):
+            if make_dirs and not os.path.isdir(taskdir):
                 os.makedirs(taskdir)
         except OSError as e:
             # fork race conditions
@@ -320,16 +2180,21 @@ class AnsibleVCR(object):
             hostdir = os.path.join(taskdir, connection.host)
         hostdir = os.path.join(taskdir, hn)
 
+        # virtual hosts replay a recorded template host's fixtures
+        self.current_host = hn
+        self.current_alias = None
+        fixture_hostdir = hostdir
+        if op == 'read':
+            template = self.get_template_host(hn, taskdir)
+            if template != hn:
+                display.vvvv('[%s] REPLAYING AS: %s' % (hn, template))
+                self.current_alias = (template, hn)
+                fixture_hostdir = os.path.join(taskdir, template)
+
         # ensure we have a place to read and write the fixtures for the host
-        if not os.path.isdir(hostdir):
+        if make_dirs and not self.current_alias and not os.path.isdir(hostdir):
             os.makedirs(hostdir)
 
-        # fixtures are timestamped for easier visual sorting
-        ts = datetime.datetime.strftime(
-            datetime.datetime.now(),
-            '%Y-%m-%d_%H-%M-%S-%f'
-        )
-
         # this is what needs to be returned so the caller knows what to
         # read or write for this connection.
         filen = None
@@ -339,70 +2204,35 @@ class AnsibleVCR(object):
             display.vvvv('WRITE FUNCTION: %s' % function)
             display.vvvv('WRITE OP: %s' % op)
 
-            prefix = os.path.join(hostdir, ts + '_' + function + '_')
-            existing = glob.glob('%s/*.json' % hostdir)
-            existing = [x for x in existing if function in x]
-            existing = [x for x in existing if x.endswith('.json')]
-            existing = [x.replace('.json', '') for x in existing]
-            existing = [x.split('_')[-1] for x in existing]
-            existing = sorted([int(x) for x in existing])
-
-            _prefix = os.path.join(hostdir, ts + '_' + function + '_')
-            if not existing:
-                filen = _prefix + '1.json'
-            else:
-                filen = _prefix + '%s.json' % (existing[-1] + 1)
+            filen = self.storage.new_fixture(hostdir, function)
 
         elif op == 'read':
             display.vvvv('[%s] READ TASKID: %s' % (hn, self.current_task_number))
             display.vvvv('[%s] READ FUNCTION: %s' % (hn, function))
             display.vvvv('[%s] READ OP: %s' % (hn, op))
 
-            existing = glob.glob('%s/*.json' % hostdir)
-            existing = [x for x in existing if function in x]
-            existing = [x for x in existing if x.endswith('.json')]
-            display.vvvv('[%s] 1. possible choices: %s' % (hn, existing))
-
-            if cmd:
-                existing = sorted(existing)
-                candidates = []
-                for ef in existing:
-                    with open(ef, 'r') as f:
-                        jdata = json.loads(f.read())
-                    if 'command' not in jdata:
-                        continue
-                    if jdata['command'][-1] == cmd[-1]:
-                        candidates.append(ef)
-                        continue
-                    if jdata['command'][-1][:30] == cmd[-1][:30]:
-                        candidates.append(ef)
-                        continue
-
-                if candidates:
-                    existing = candidates[:]
-                display.vvvv('[%s] 2. possible choices: %s' % (hn, existing))
-
-            existing = [x.replace('.json', '') for x in existing]
-            existing = [x.split('_')[-1] for x in existing]
-            existing = sorted([int(x) for x in existing], reverse=True)
-            display.vvvv('[%s] 3. possible choices: %s' % (hn, existing))
-
             # use the last file to increment for this call
-            lastf = self.fixture_logger.get_last_file(self.current_task_number, hostdir, function)
+            lastf = self.storage.get_last_file(self.current_task_number, hostdir, function)
             display.v('[%s] READ LASTFILE: %s' % (hn, lastf))
 
             # increment the id of the file
             if lastf is None:
                 fileid = 1
             else:
-                fileid = lastf.split('_')[-1].replace('.json', '')
-                fileid = int(fileid)
-                fileid += 1
+                fileid = fixture_index(lastf) + 1
             display.vvvv('[' + hn + '] READ FID: ' + str(fileid))
 
+            # if the next fixture in sequence was recorded for another
+            # command, skip ahead to the next one recorded for this command
+            fingerprint = None
+            if cmd:
+                ckey = command_key(cmd)
+                if self.current_alias:
+                    ckey = replace_host(to_text(ckey, errors='surrogate_or_strict'), hn, self.current_alias[0])
+                fingerprint = command_fingerprint(ckey)
+
             # try to find the file with the new id
-            suffix = '_%s_%s.json' % (function, fileid)
-            _existing = glob.glob('%s/*%s' % (hostdir, suffix))
+            _existing = self.storage.find_fixtures(fixture_hostdir, function, fileid, fingerprint=fingerprint)
             display.v('[%s] READ _EXISTING: %s' % (hn, _existing))
 
             # openshift hackaround - just send the last one again ... ?
@@ -413,17 +2243,30 @@ class AnsibleVCR(object):
                 filen = _existing[-1]
             else:
                 display.error('[%s] _existing: %s' % (hn, _existing))
-                breakhost = os.environ.get('ANSIBLE_VCR_HOST_BREAK')
+                breakhost = self.config.host_break
                 if not breakhost or breakhost == hn:
                     import epdb; epdb.st()
                 filen = None
 
-            self.fixture_logger.set_last_file(self.current_task_number, hostdir, function, filen)
+            self.storage.set_last_file(self.current_task_number, hostdir, function, filen)
 
         display.vvvv('[' + hn + '] RETURN FILE: ' + str(filen))
         return filen
 
-    def record_exec_command(self, connection, command, returncode, stdout, stderr, strace_info=None):
+    @timed('replay_delay')
+    def _replay_delay(self, jdata, start):
+        '''Hold a replayed call until it has taken as long as it did when
+        recorded, divided by the play speed. The time spent reading the
+        fixture counts towards that.'''
+        scale = self.config.play_scale
+        if not scale or not jdata.get('duration'):
+            return
+        delay = jdata['duration'] / scale - (time.time() - start)
+        if delay > 0:
+            time.sleep(delay)
+
+    @timed('record_exec_command')
+    def record_exec_command(self, connection, command, returncode, stdout, stderr, capture_info=None, duration=None):
 
         fixture_file = self.get_fixture_file(
             'exec',
@@ -432,93 +2275,44 @@ class AnsibleVCR(object):
         )
 
         # build the datastructure with everything we know ...
-        jdata = self._serialize_all_info(connection, returncode, stdout, stderr, command=command)
-        if strace_info:
-            jdata['command'] = strace_info['cmd']
-            jdata['strace_info'] = strace_info.copy()
-            if os.path.isdir(strace_info['dir']):
-                sp = StraceProcessor(strace_info['dir'])
-                created = sp.get_created()
-                removed = sp.get_removed()
-
-                fdir = fixture_file.replace('.json', '.strace')
-                shutil.copytree(strace_info['dir'], fdir)
-                shutil.rmtree(strace_info['dir'])
-
-                if created or removed:
-                    jdata['removed'] = removed[:]
-
-                    artifacts = fixture_file.replace('.json', '.artifacts')
-                    if not os.path.isdir(artifacts):
-                        os.makedirs(artifacts)
-
-                    jdata['created'] = {}
-                    for create in created:
-                        if not os.path.isfile(create):
-                            continue
-                        dest = os.path.join(artifacts, os.path.basename(create))
-                        if os.path.isdir(create):
-                            shutil.copytree(create, dest)
-                        else:
-                            shutil.copy(create, dest)
-                        jdata['created'][create] = dest
+        jdata = self._serialize_all_info(connection, returncode, stdout, stderr, command=command, duration=duration)
+        jdata['fingerprint'] = command_fingerprint(command_key(command))
+        if capture_info:
+            (created, removed) = self._finish_capture(capture_info, fixture_file, jdata)
+            if created or removed:
+                jdata['removed'] = removed[:]
+
+                jdata['created'] = {}
+                for create in created:
+                    if not os.path.isfile(create):
+                        continue
+                    jdata['created'][create] = self.storage.put_blob(create)
 
-                    #import epdb; epdb.st()
+                #import epdb; epdb.st()
 
-        with open(fixture_file, 'w') as f:
-            f.write(json.dumps(jdata, indent=2))
+        self.storage.save_fixture(fixture_file, 'exec', jdata)
 
 
+    @timed('read_exec_command')
     def read_exec_command(self, connection, cmd):
+        start = time.time()
         display.v('FIXTURE_EXEC_INDEX: %s' % self.exec_index)
         fixture_file = self.get_fixture_file('exec', 'read', connection=connection, cmd=cmd)
 
-        with open(fixture_file, 'r') as f:
-            jdata = json.loads(f.read())
+        jdata = self._alias_fixture(self.storage.load_fixture(fixture_file))
 
         display.v('IN CMD: %s' % cmd[-1])
         display.v('OUT CMD(1): %s' % jdata['command'][-1])
 
-        if cmd[-1] != jdata['command'][-1] and 'ansible-tmp' in cmd[-1]:
-            #  /home/vagrant/.ansible/tmp/ansible-tmp-1523577514.5-202990892955254
-            orig = None
-            curr = None
-            try:
-                curr = re.search('ansible-tmp-[0-9]+\.[0-9]+\-[0-9]+', cmd[-1]).group()
-                orig = re.search('ansible-tmp-[0-9]+\.[0-9]+\-[0-9]+', jdata['command'][-1]).group()
-            except Exception as e:
-                display.vvv('ERROR: %s' % e)
-                pass
-
-            if orig and curr:
-                jdata['stdout'] = jdata['stdout'].replace(orig, curr)
-                jdata['stderr'] = jdata['stderr'].replace(orig, curr)
-
-                fixed_cmd = jdata['command'][-1].replace(orig, curr)
-                #if cmd[-1] != fixed_cmd:
-                #    import epdb; epdb.st()
-                jdata['command'][-1] = fixed_cmd[:]
-
-        if cmd[-1] != jdata['command'][-1] and 'BECOME-SUCCESS' in cmd[-1]:
-            # echo BECOME-SUCCESS-ocuebsgsnklcydfcjeakuxyvjdbuymhn;
-            #import epdb; epdb.st()
-            orig = None
-            curr = None
-            try:
-                curr = re.search('BECOME-SUCCESS-[\w]+', cmd[-1]).group()
-                orig = re.search('BECOME-SUCCESS-[\w]+', jdata['command'][-1]).group()
-            except Exception as e:
-                display.vvv('ERROR: %s' % e)
-                pass
-
-            if orig and curr:
-                jdata['stdout'] = jdata['stdout'].replace(orig, curr)
-                jdata['stderr'] = jdata['stderr'].replace(orig, curr)
+        #  /home/vagrant/.ansible/tmp/ansible-tmp-1523577514.5-202990892955254
+        #  echo BECOME-SUCCESS-ocuebsgsnklcydfcjeakuxyvjdbuymhn;
+        jdata = self._fill_placeholders(jdata, cmd=cmd)
 
-                fixed_cmd = jdata['command'][-1].replace(orig, curr)
-                #if cmd[-1] != fixed_cmd:
-                #    import epdb; epdb.st()
-                jdata['command'][-1] = fixed_cmd[:]
+        # fast play skips replaying the filesystem changes strace saw
+        if self.config.fast_play:
+            display.v('OUT CMD(2): %s' % jdata['command'][-1])
+            self._replay_delay(jdata, start)
+            return (jdata['returncode'], jdata['stdout'], jdata['stderr'])
 
         if jdata.get('removed'):
             for fn in jdata['removed']:
@@ -540,17 +2334,23 @@ class AnsibleVCR(object):
                 if not os.path.isdir(dirname):
                     os.makedirs(dirname)
 
-                if os.path.isfile(v):
-                    shutil.copy(v, k)
+                if not os.path.isabs(v):
+                    self.storage.get_blob(v, k)
+                elif os.path.isfile(v):
+                    # recorded before the blob store existed
+                    restore_file(v, k, method=self.config.restore)
                 else:
                     shutil.copytree(k, v)
             #import epdb; epdb.st()
 
         display.v('OUT CMD(2): %s' % jdata['command'][-1])
 
+        self._replay_delay(jdata, start)
+
         return (jdata['returncode'], jdata['stdout'], jdata['stderr'])
 
-    def record_put_file(self, connection, in_path, out_path, returncode, stdout, stderr):
+    @timed('record_put_file')
+    def record_put_file(self, connection, in_path, out_path, returncode, stdout, stderr, duration=None):
         self.put_index += 1
 
         fixture_file = self.get_fixture_file('put', 'record', connection=connection)
@@ -560,40 +2360,30 @@ class AnsibleVCR(object):
             stdout,
             stderr,
             in_path=in_path,
-            out_path=out_path
+            out_path=out_path,
+            duration=duration
         )
 
-        with open(fixture_file, 'w') as f:
-            f.write(json.dumps(jdata, indent=2))
+        # the payload is stored once per unique content rather than per host
+        jdata['content'] = self.storage.put_blob(in_path)
 
-        fixture_index = os.path.basename(fixture_file)
-        fixture_index = fixture_index.replace('.json', '')
-        fixture_index = fixture_index.split('_')[-1]
-        fixture_date = '_'.join(fixture_file.split('_')[0:2])
-
-        content_file = os.path.join(
-            os.path.dirname(fixture_file),
-            '%s_put_content_%s_%s' % (
-                fixture_date, fixture_index, os.path.basename(out_path)
-            )
-        )
-
-        if not os.path.isdir(in_path):
-            shutil.copy(in_path, content_file)
-        else:
-            shutil.copytree(in_path, content_file)
+        self.storage.save_fixture(fixture_file, 'put', jdata)
 
+    @timed('read_put_file')
     def read_put_file(self, connection, in_path, out_path):
+        start = time.time()
         self.put_index += 1
         display.v('FIXTURE_PUT_INDEX: %s' % self.put_index)
         fixture_file = self.get_fixture_file('put', 'read', connection=connection)
 
-        with open(fixture_file, 'r') as f:
-            jdata = json.loads(f.read())
+        jdata = self._fill_placeholders(self._alias_fixture(self.storage.load_fixture(fixture_file)))
+
+        self._replay_delay(jdata, start)
 
         return (jdata['returncode'], jdata['stdout'], jdata['stderr'])
 
-    def record_fetch_file(self, connection, in_path, out_path, returncode, stdout, stderr):
+    @timed('record_fetch_file')
+    def record_fetch_file(self, connection, in_path, out_path, returncode, stdout, stderr, duration=None):
         self.fetch_index += 1
         fixture_file = self.get_fixture_file('fetch', 'record', connection=connection)
 
@@ -603,33 +2393,31 @@ class AnsibleVCR(object):
             stdout,
             stderr,
             in_path=in_path,
-            out_path=out_path
+            out_path=out_path,
+            duration=duration
         )
 
-        with open(fixture_file, 'w') as f:
-            f.write(json.dumps(jdata, indent=2))
-
-        fixture_index = os.path.basename(fixture_file)
-        fixture_index = fixture_index.replace('.json', '')
-        fixture_index = fixture_index.split('_')[-1]
-        fixture_date = '_'.join(fixture_file.split('_')[0:2])
+        if os.path.exists(out_path):
+            jdata['content'] = self.storage.put_blob(out_path)
 
-        content_file = os.path.join(
-            os.path.dirname(fixture_file),
-            '%s_fetch_content_%s_%s' % (fixture_date, fixture_index, os.path.basename(out_path))
-        )
-        if not os.path.isdir(out_path):
-            shutil.copy(out_path, content_file)
-        else:
-            shutil.copytree(out_path, content_file)
+        self.storage.save_fixture(fixture_file, 'fetch', jdata)
 
+    @timed('read_fetch_file')
     def read_fetch_file(self, connection, in_path, out_path):
+        start = time.time()
         self.fetch_index += 1
         fixture_file = self.get_fixture_file('fetch', 'read', connection=connection)
 
-        with open(fixture_file, 'r') as f:
-            jdata = json.loads(f.read())
+        jdata = self._fill_placeholders(self._alias_fixture(self.storage.load_fixture(fixture_file)))
+
+        # an empty fetched directory is stored as {}
+        if 'content' in jdata:
+            self.storage.get_blob(jdata['content'], out_path)
+            self._replay_delay(jdata, start)
+            return (jdata['returncode'], jdata['stdout'], jdata['stderr'])
 
+        # recordings made before the blob store keep the content next to
+        # the fixture ...
         # /tmp/fixtures/4/el7host/1_fetch_content_foobar
         # 2018-04-13_08-33-17-377361_fetch_content_1_foobar
 
@@ -661,8 +2449,10 @@ class AnsibleVCR(object):
         content_file = candidates[-1]
 
         if not os.path.isdir(content_file):
-            shutil.copy(content_file, out_path)
+            restore_file(content_file, out_path, method=self.config.restore)
         else:
             shutil.copytree(content_file, out_path)
 
+        self._replay_delay(jdata, start)
+
         return (jdata['returncode'], jdata['stdout'], jdata['stderr'])
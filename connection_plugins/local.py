@@ -40,6 +40,7 @@ import shutil
 import subprocess
 import fcntl
 import getpass
+import time
 
 import ansible.constants as C
 from ansible.compat import selectors
@@ -96,7 +97,7 @@ class Connection(ConnectionBase):
         super(Connection, self).exec_command(cmd, in_data=in_data, sudoable=sudoable)
 
         display.debug("in local.exec_command()")
-        mode = os.environ.get('ANSIBLE_VCR_MODE', '').lower()
+        mode = avcr.mode
 
         executable = C.DEFAULT_EXECUTABLE.split()[0] if C.DEFAULT_EXECUTABLE else None
 
@@ -108,12 +109,13 @@ class Connection(ConnectionBase):
         else:
             cmd = map(to_bytes, cmd)
 
-        # inject strace
+        # inject strace (or whichever capture backend is configured)
         sinfo = None
         if mode == 'record':
-            (cmd, sinfo) = avcr.get_strace_exec(self, cmd)
+            (cmd, sinfo) = avcr.get_capture_exec(self, cmd)
 
         if not mode or mode == 'record':
+            start = time.time()
             p = subprocess.Popen(
                 cmd,
                 shell=isinstance(cmd, (text_type, binary_type)),
@@ -159,11 +161,12 @@ class Connection(ConnectionBase):
 
             display.debug("getting output with communicate()")
             stdout, stderr = p.communicate(in_data)
+            duration = time.time() - start
             display.debug("done communicating")
 
             display.debug("done with local.exec_command()")
             if mode == 'record':
-                avcr.record_exec_command(self, cmd, p.returncode, stdout, stderr, strace_info=sinfo)
+                avcr.record_exec_command(self, cmd, p.returncode, stdout, stderr, capture_info=sinfo, duration=duration)
 
             return (p.returncode, stdout, stderr)
 
@@ -176,15 +179,16 @@ class Connection(ConnectionBase):
         ''' transfer a file from local to local '''
 
         super(Connection, self).put_file(in_path, out_path)
-        mode = os.environ.get('ANSIBLE_VCR_MODE', '').lower()
+        mode = avcr.mode
 
         display.vvv(u"PUT {0} TO {1}".format(in_path, out_path), host=self._play_context.remote_addr)
 
         if not mode or mode == 'record':
 
+            start = time.time()
             self._put_file(in_path, out_path)
             if mode == 'record':
-                avcr.record_put_file(self, in_path, out_path, 0, '', '')
+                avcr.record_put_file(self, in_path, out_path, 0, '', '', duration=time.time() - start)
 
         elif mode == 'play':
 
@@ -205,13 +209,14 @@ class Connection(ConnectionBase):
         ''' fetch a file from local to local -- for copatibility '''
 
         super(Connection, self).fetch_file(in_path, out_path)
-        mode = os.environ.get('ANSIBLE_VCR_MODE', '').lower()
+        mode = avcr.mode
 
         display.vvv(u"FETCH {0} TO {1}".format(in_path, out_path), host=self._play_context.remote_addr)
         if not mode or mode == 'record':
+            start = time.time()
             self._put_file(in_path, out_path)
             if mode == 'record':
-                avcr.record_fetch_file(self, in_path, out_path, 0, '', '')
+                avcr.record_fetch_file(self, in_path, out_path, 0, '', '', duration=time.time() - start)
         elif mode == 'play':
             (returncode, stdout, stderr) = avcr.read_fetch_file(self, in_path, out_path)
 
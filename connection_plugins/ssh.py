@@ -989,7 +989,7 @@ class Connection(ConnectionBase):
         super(Connection, self).exec_command(cmd, in_data=in_data, sudoable=sudoable)
 
         display.vvv('#########################################################################')
-        mode = os.environ.get('ANSIBLE_VCR_MODE', '').lower()
+        mode = avcr.mode
 
         display.vvv(u"ESTABLISH SSH CONNECTION FOR USER: {0}".format(self._play_context.remote_user), host=self._play_context.remote_addr)
         display.vvv('#########################################################################')
@@ -1020,10 +1020,12 @@ class Connection(ConnectionBase):
             display.vvv('# se: %s' % '\n'.join([x for x in stderr.split('\n') if not x.startswith('debug')])[:50])
             #import epdb; epdb.st()
         else:
+            start = time.time()
             (returncode, stdout, stderr) = self._run(cmd, in_data, sudoable=sudoable)
+            duration = time.time() - start
 
             if mode == 'record':
-                avcr.record_exec_command(self, cmd, returncode, stdout, stderr)
+                avcr.record_exec_command(self, cmd, returncode, stdout, stderr, duration=duration)
 
         return (returncode, stdout, stderr)
 
@@ -1031,7 +1033,7 @@ class Connection(ConnectionBase):
         ''' transfer a file from local to remote '''
 
         super(Connection, self).put_file(in_path, out_path)
-        mode = os.environ.get('ANSIBLE_VCR_MODE', '').lower()
+        mode = avcr.mode
 
         display.vvv('#########################################################################')
         display.vvv(u"PUT {0} TO {1}".format(in_path, out_path), host=self.host)
@@ -1040,8 +1042,9 @@ class Connection(ConnectionBase):
             raise AnsibleFileNotFound("file or module does not exist: {0}".format(to_native(in_path)))
 
         if mode == 'record':
+            start = time.time()
             (returncode, stdout, stderr) = self._file_transport_command(in_path, out_path, 'put')
-            avcr.record_put_file(self, in_path, out_path, returncode, stdout, stderr)
+            avcr.record_put_file(self, in_path, out_path, returncode, stdout, stderr, duration=time.time() - start)
             return (returncode, stdout, stderr)
         elif mode == 'play':
             (returncode, stdout, stderr) = avcr.read_put_file(self, in_path, out_path)
@@ -1057,14 +1060,15 @@ class Connection(ConnectionBase):
         ''' fetch a file from remote to local '''
 
         super(Connection, self).fetch_file(in_path, out_path)
-        mode = os.environ.get('ANSIBLE_VCR_MODE', '').lower()
+        mode = avcr.mode
 
         display.vvv('#########################################################################')
         display.vvv(u"FETCH {0} TO {1}".format(in_path, out_path), host=self.host)
         display.vvv('#########################################################################')
         if mode == 'record':
+            start = time.time()
             (returncode, stdout, stderr) = self._file_transport_command(in_path, out_path, 'get')
-            avcr.record_fetch_file(self, in_path, out_path, returncode, stdout, stderr)
+            avcr.record_fetch_file(self, in_path, out_path, returncode, stdout, stderr, duration=time.time() - start)
             return (returncode, stdout, stderr)
         elif mode == 'play':
             (returncode, stdout, stderr) = avcr.read_fetch_file(self, in_path, out_path)